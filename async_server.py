@@ -0,0 +1,289 @@
+import time, sys, asyncio, socket
+from random import sample
+
+import utils
+from utils import DEBUG_LEVEL, TERM, Communication_Handler
+
+import server_trainer
+
+debug_level = DEBUG_LEVEL.INFO
+
+# State kept by the event loop for a single connected client.
+class AsyncClientConnection():
+    def __init__(self, addr, reader, writer):
+        self.addr = addr
+        self.reader = reader
+        self.writer = writer
+
+        # complete frames received from the client (filled by the reader task).
+        self.inbox = asyncio.Queue()
+
+class AsyncServer():
+    def __init__(self, host):
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_info('Started server at ' + str(host))
+
+        self.host = host
+        self.listener = None
+
+        # TODO: make number variable
+        self.BACKLOG = 1024
+
+        # the set of connected clients.
+        self.connected_clients_by_addr = {}
+
+    # Accepts connections on the event loop (no dedicated listener thread).
+    async def start(self):
+        self.listener = await asyncio.start_server(self.handle_client, self.host[0], self.host[1], backlog = self.BACKLOG, reuse_address = True)
+
+    # Stops accepting new connections.
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.close()
+            await self.listener.wait_closed()
+            self.listener = None
+
+    # Registers a new client and starts reading its frames.
+    async def handle_client(self, reader, writer):
+        client_addr = writer.get_extra_info('peername')
+
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_success('Established connection to {}'.format(client_addr))
+
+        client = AsyncClientConnection(client_addr, reader, writer)
+        self.connected_clients_by_addr[client_addr] = client
+
+        await self.read_frames(client)
+
+    # Reads complete frames into the client's inbox until the peer goes away.
+    async def read_frames(self, client):
+        try:
+            while True:
+                msg = await Communication_Handler.read_msg(client.reader)
+
+                # (connection management messages carry no update)
+                if Communication_Handler.control_msg(msg) in ('heartbeat', 'hello'):
+                    continue
+
+                self.reply_received(client.addr, msg)
+                client.inbox.put_nowait(msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if debug_level >= DEBUG_LEVEL.WARNS:
+                TERM.write_warning('Connection to {} closed.'.format(client.addr))
+        except asyncio.CancelledError:
+            pass
+        except:
+            TERM.write_failure('Peer {}: Receive error {}'.format(client.addr, sys.exc_info()[0]))
+        finally:
+            self.remove_client(client.addr)
+
+    # A client's reply (an update or a cancellation) was read.
+    def reply_received(self, addr, msg):
+        pass
+
+    # Removes the specified client if it exists.
+    def remove_client(self, addr):
+        client = self.connected_clients_by_addr.pop(addr, None)
+        if client is not None:
+            client.writer.close()
+            # wake up anyone waiting on this client's update.
+            client.inbox.put_nowait(None)
+
+    # Broadcasts a message to a subset of the clients (serialized once, written concurrently).
+    async def broadcast(self, client_addrs, msg, timeout = None):
+        buffers = Communication_Handler.pack_msg(msg)
+        msg_len = Communication_Handler.frame_size(buffers)
+
+        async def send(client):
+            start = time.time()
+            try:
+                client.writer.writelines(buffers)
+                await asyncio.wait_for(client.writer.drain(), timeout)
+                return client.addr, (time.time() - start, msg_len)
+            except:
+                TERM.write_failure('Peer {}: Send Error \'{}\''.format(client.addr, sys.exc_info()[0]))
+                self.remove_client(client.addr)
+                return client.addr, (time.time() - start, 0)
+
+        clients = [self.connected_clients_by_addr[addr] for addr in client_addrs if addr in self.connected_clients_by_addr]
+
+        # per-client (latency in seconds, bytes sent).
+        return dict(await asyncio.gather(*[send(client) for client in clients]))
+
+class AsyncFLServer(AsyncServer):
+
+    def __init__(self, host, trainer):
+        super(AsyncFLServer, self).__init__(host)
+
+        # FL Model trainer
+        self.trainer = trainer
+        self.subset_size = 3 # Default
+
+        # Per-client deadline (seconds) for returning an update.
+        self.TIMEOUT = 600
+
+        # Tag of the latest broadcast (echoed in the clients' replies), and the tag each busy client is training on.
+        self.broadcast_version = 0
+        self.busy_clients = {}
+
+    # Executes FL Training Loop
+    async def train(self):
+        loop = asyncio.get_running_loop()
+
+        while len(self.connected_clients_by_addr) > 0:
+            # select a subset of the clients and broadcast the model.
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info("Selecting clients...")
+
+            selected_client_addrs = self.select_clients(self.subset_size)
+
+            # (every client is still busy with an earlier broadcast)
+            if len(selected_client_addrs) == 0:
+                await asyncio.sleep(1.0)
+                continue
+
+            # start a fresh running aggregate for this round.
+            self.trainer.begin_aggregation()
+
+            # discard anything left over from a previous (timed out) round.
+            for addr in selected_client_addrs:
+                inbox = self.connected_clients_by_addr[addr].inbox
+                while not inbox.empty():
+                    inbox.get_nowait()
+
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info("Broadcasting model...")
+
+            await self.broadcast_model(selected_client_addrs)
+
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info("Waiting for updates...(Timeout: " + str(self.TIMEOUT) + "s)")
+
+            updates = await self.wait_for_updates(selected_client_addrs, time.time() + self.TIMEOUT)
+
+            # cancel the updates that missed the deadline (the clients stay busy until they reply).
+            await self.broadcast([addr for addr in selected_client_addrs if addr not in updates], Communication_Handler.CANCEL_MSG, self.TIMEOUT)
+
+            # if every selected client responded...
+            if len(updates) > 0 and len(updates) == len(selected_client_addrs):
+                if debug_level >= DEBUG_LEVEL.INFO:
+                    TERM.write_success("All updates received.")
+                    TERM.write_info("Aggregating updates...")
+
+                # Finalize and update off the event loop so accepts and reads continue.
+                aggregated_update = await loop.run_in_executor(None, self.trainer.finalize_aggregation)
+                await loop.run_in_executor(None, self.update_model, aggregated_update)
+            else:
+                if debug_level >= DEBUG_LEVEL.INFO:
+                    TERM.write_warning("Time-limit exceeded: {}/{} updates were received.".format(len(updates), len(selected_client_addrs)))
+
+        # let the last round's (background) evaluation finish.
+        await loop.run_in_executor(None, self.trainer.wait_for_evaluations)
+
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_failure("All clients disconected.")
+
+    ### FL Training Loop ###
+
+    # Randomly select subset of all client to train on (clients still busy with an earlier broadcast can't be selected)
+    def select_clients(self, subset_size):
+        available_addrs = [addr for addr in self.connected_clients_by_addr.keys() if addr not in self.busy_clients]
+        return sample(available_addrs, min(subset_size, len(available_addrs)))
+
+    # Broadcast model to selected clients so they can train
+    # (tagged with a new broadcast version, which the clients echo in their replies)
+    async def broadcast_model(self, client_addrs):
+        # Verify there are clients
+        if len(client_addrs) > 0:
+            self.broadcast_version += 1
+            for addr in client_addrs:
+                self.busy_clients[addr] = self.broadcast_version
+
+            await self.broadcast(client_addrs, { 'version' : self.broadcast_version, 'weights' : self.trainer.flat_state() }, self.TIMEOUT)
+            return True
+
+        return False
+
+    # Retrieve updates of selected clients, enforcing the deadline per client
+    # (each update is folded into the running aggregate as soon as it arrives).
+    async def wait_for_updates(self, client_addrs, deadline):
+        version = self.broadcast_version
+
+        async def recv_update(addr):
+            client = self.connected_clients_by_addr.get(addr)
+            if client is None:
+                return addr, None
+
+            while True:
+                try:
+                    msg = await asyncio.wait_for(client.inbox.get(), max(0, deadline - time.time()))
+                except asyncio.TimeoutError:
+                    if debug_level >= DEBUG_LEVEL.WARNS:
+                        TERM.write_warning('Peer {}: deadline missed.'.format(addr))
+                    return addr, None
+
+                if msg is None:
+                    return addr, None
+
+                # a late reply to an earlier broadcast (its update or its cancellation): drop it.
+                if isinstance(msg, dict) and msg.get('version') == version:
+                    break
+
+                if debug_level >= DEBUG_LEVEL.ALL:
+                    TERM.write('\tDropping a reply from {} to an earlier broadcast.'.format(addr))
+
+            # the client gave up on its update.
+            if Communication_Handler.control_msg(msg) is not None:
+                return addr, None
+
+            update, num_samples = Communication_Handler.unpack_update(msg)
+            self.trainer.accumulate(update, num_samples)
+            return addr, num_samples
+
+        results = await asyncio.gather(*[recv_update(addr) for addr in client_addrs])
+        return { addr : num_samples for addr, num_samples in results if num_samples is not None }
+
+    # A reply to the broadcast a client is training on makes it available again
+    def reply_received(self, addr, msg):
+        if isinstance(msg, dict) and msg.get('version') == self.busy_clients.get(addr):
+            self.busy_clients.pop(addr)
+
+    def remove_client(self, addr):
+        super(AsyncFLServer, self).remove_client(addr)
+        self.busy_clients.pop(addr, None)
+
+    # Update server model (centralized model)
+    def update_model(self, aggregated_update):
+        self.trainer.update(aggregated_update)
+
+### Main Code ###
+
+BUFFER_TIME = 5
+
+async def main(host):
+    # Initialize the FL server.
+    flServer = AsyncFLServer(host, server_trainer.ServerTrainer())
+
+    # Allow client to connect
+    await flServer.start()
+
+    # Buffer for clients to connect
+    TERM.write_info('Waiting for clients to connect...(Timeout: ' + str(BUFFER_TIME) + 's)')
+    await asyncio.sleep(BUFFER_TIME)
+
+    if len(flServer.connected_clients_by_addr) == 0:
+        TERM.write_failure("Time limit exceeed: No clients connected.")
+    else:
+        # Train the FL server model (clients may keep connecting meanwhile).
+        TERM.write_warning('Time limit exceeded: ' + str(len(flServer.connected_clients_by_addr)) + ' client(s) connected.')
+        TERM.write_info("Starting FL training loop...")
+        await flServer.train()
+
+    await flServer.stop()
+
+if __name__ == '__main__':
+    # the socket for the server.
+    server_hostname = socket.gethostbyname('localhost')
+    server_port = 8080
+
+    asyncio.run(main((server_hostname, server_port)))
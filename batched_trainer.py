@@ -0,0 +1,208 @@
+import time, copy
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+try:
+    from torch.func import vmap, functional_call, stack_module_state
+except ImportError:
+    vmap = None
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+from instrumentation import RECORDER
+
+debug_level = DEBUG_LEVEL.INFO
+
+# Trains K client replicas (ClientTrainers of one architecture) at once: their parameters are stacked
+# and a single vmapped forward/backward pass handles a batch of every replica. Each replica keeps its
+# own data shard and momentum buffers, so the result matches training the clients one after another.
+# Each epoch's batches are gathered from the shards at once, and the SGD step runs as fused (foreach) ops
+# over the stacked parameters. (falls back to training one after another when torch.func is not available)
+class BatchedTrainer():
+    def __init__(self, trainers):
+        self.trainers = trainers
+
+        # Hyperparameters (shared by the replicas)
+        self.num_epochs = trainers[0].num_epochs
+        self.lr = trainers[0].lr
+        self.momentum = trainers[0].momentum
+        self.batch_size = trainers[0].batch_size
+        self.proximal_mu = trainers[0].proximal_mu
+
+        self.layout = trainers[0].layout
+
+    # Whether the replicas can be trained together
+    def batched(self):
+        return vmap is not None and len(self.trainers) > 1
+
+    # Train every replica from the weights loaded into its model, returning their flat weights ([K, numel])
+    def train(self):
+        if not self.batched():
+            for trainer in self.trainers:
+                trainer.train()
+            return torch.stack([trainer.layout.flatten(trainer.model.state_dict()) for trainer in self.trainers])
+
+        start = time.time()
+        num_replicas = len(self.trainers)
+        device = next(self.trainers[0].model.parameters()).device
+
+        # Stacked parameters (leading replica dimension) and a stateless copy of the model to call
+        params, buffers = stack_module_state([trainer.model for trainer in self.trainers])
+        base_model = copy.deepcopy(self.trainers[0].model).to('meta')
+
+        def forward(params, buffers, inputs):
+            return functional_call(base_model, (params, buffers), (inputs,))
+
+        batched_forward = vmap(forward)
+
+        # Momentum buffers (fresh each round, like each client's optimizer)
+        momentum_buffers = { key : None for key in params }
+
+        # Received weights, for the FedProx term
+        anchors = { key : param.detach().clone() for key, param in params.items() } if self.proximal_mu > 0 else None
+        running_loss = torch.zeros(num_replicas, device=device)
+
+        for epoch in range(self.num_epochs):
+            running_loss.zero_()
+
+            for inputs, targets, mask, active in self.epoch_batches(device):
+                outputs = batched_forward(params, buffers, inputs)
+                losses = F.cross_entropy(outputs.flatten(0, 1), targets.flatten(), reduction='none').view(num_replicas, -1)
+
+                # mean loss of each replica over its own (unpadded) batch
+                replica_loss = (losses * mask).sum(1) / mask.sum(1).clamp(min=1)
+                replica_loss.sum().backward()
+
+                self.sgd_step(params, momentum_buffers, active, anchors)
+                running_loss += replica_loss.detach()
+
+        # Write the trained weights back into each replica's model
+        flat_weights = torch.cat([(params[key] if key in params else buffers[key]).detach().reshape(num_replicas, -1).to(torch.float32) for key in self.layout.keys], 1)
+        elapsed = time.time() - start
+
+        num_batches = [max(1, len(trainer.train_loader)) for trainer in self.trainers]
+        for i, trainer in enumerate(self.trainers):
+            trainer.model.load_state_dict(trainer.layout.as_state_dict(flat_weights[i]))
+            trainer.last_train_time = elapsed
+            trainer.last_loss = float(running_loss[i]) / num_batches[i]
+
+        RECORDER.record('train_batched', start, elapsed, { 'replicas' : num_replicas, 'epochs' : self.num_epochs })
+
+        if debug_level >= DEBUG_LEVEL.ALL:
+            TERM.write('\tTrained {} replicas in {:0.2f}s'.format(num_replicas, elapsed))
+
+        return flat_weights
+
+    # An epoch of batches of every replica: (inputs, targets, mask of the real samples, replicas with a batch),
+    # padded to the batch size. Shard loaders are read once per epoch (one gather per replica, each step's
+    # batches are then slices); other loaders are iterated batch by batch.
+    def epoch_batches(self, device):
+        loaders = [trainer.train_loader for trainer in self.trainers]
+        if not all(hasattr(loader, 'indices') and hasattr(loader, 'get_batch') for loader in loaders):
+            iterators = [iter(loader) for loader in loaders]
+            active = [True] * len(loaders)
+            while True:
+                inputs, targets, mask, active = self.next_batches(iterators, active, device)
+                if not any(active):
+                    return
+                yield inputs, targets, mask, torch.tensor(active, device=device)
+
+        num_replicas = len(loaders)
+        num_batches = max(len(loader) for loader in loaders)
+        inputs, targets = None, None
+        mask = torch.zeros(num_replicas, num_batches * self.batch_size, device=device)
+
+        for i, loader in enumerate(loaders):
+            # (the same sample order as iterating the loader, up to the order within a batch)
+            order = np.random.permutation(loader.indices) if loader.shuffle else loader.indices
+            replica_inputs, replica_targets = loader.get_batch(order)
+            if inputs is None:
+                inputs = torch.zeros((num_replicas, num_batches * self.batch_size) + tuple(replica_inputs.shape[1:]), dtype=replica_inputs.dtype, device=device)
+                targets = torch.zeros((num_replicas, num_batches * self.batch_size), dtype=replica_targets.dtype, device=device)
+
+            size = replica_inputs.shape[0]
+            inputs[i, :size] = replica_inputs
+            targets[i, :size] = replica_targets
+            mask[i, :size] = 1.0
+
+        # step-major (each step's batches are contiguous)
+        inputs = inputs.view((num_replicas, num_batches, self.batch_size) + tuple(inputs.shape[2:])).transpose(0, 1).contiguous()
+        targets = targets.view(num_replicas, num_batches, self.batch_size).transpose(0, 1).contiguous()
+        mask = mask.view(num_replicas, num_batches, self.batch_size).transpose(0, 1).contiguous()
+        active = torch.arange(num_batches, device=device).unsqueeze(1) < torch.tensor([len(loader) for loader in loaders], device=device).unsqueeze(0)
+
+        for step in range(num_batches):
+            yield inputs[step], targets[step], mask[step], active[step]
+
+    # Next batch of every replica, padded to the batch size (replicas done with their shard stop)
+    def next_batches(self, loaders, active, device):
+        num_replicas = len(loaders)
+        inputs, targets, mask = None, None, torch.zeros(num_replicas, self.batch_size, device=device)
+        active = list(active)
+
+        for i, loader in enumerate(loaders):
+            if not active[i]:
+                continue
+
+            batch = next(loader, None)
+            if batch is None:
+                active[i] = False
+                continue
+
+            batch_inputs, batch_targets = batch
+            if inputs is None:
+                inputs = torch.zeros((num_replicas, self.batch_size) + tuple(batch_inputs.shape[1:]), dtype=batch_inputs.dtype, device=device)
+                targets = torch.zeros((num_replicas, self.batch_size), dtype=batch_targets.dtype, device=device)
+
+            size = batch_inputs.shape[0]
+            inputs[i, :size] = batch_inputs
+            targets[i, :size] = batch_targets
+            mask[i, :size] = 1.0
+
+        return inputs, targets, mask, active
+
+    # SGD with momentum (as torch.optim.SGD) applied only to the replicas that had a batch
+    # (with the FedProx term's gradient added, if anchors are given)
+    def sgd_step(self, params, momentum_buffers, active, anchors=None):
+        with torch.no_grad():
+            keys = [key for key, param in params.items() if param.grad is not None]
+            stacked = [params[key] for key in keys]
+            grads = [param.grad for param in stacked]
+
+            if anchors is not None:
+                torch._foreach_add_(grads, stacked, alpha=self.proximal_mu)
+                torch._foreach_add_(grads, [anchors[key] for key in keys], alpha=-self.proximal_mu)
+
+            if bool(active.all()):
+                # every replica steps: fused over all the parameters
+                if self.momentum != 0:
+                    if momentum_buffers[keys[0]] is None:
+                        for key, grad in zip(keys, grads):
+                            momentum_buffers[key] = grad.clone()
+                    else:
+                        buffers = [momentum_buffers[key] for key in keys]
+                        torch._foreach_mul_(buffers, self.momentum)
+                        torch._foreach_add_(buffers, grads)
+                    grads = [momentum_buffers[key] for key in keys]
+
+                torch._foreach_add_(stacked, grads, alpha=-self.lr)
+            else:
+                # (the end of an epoch, some replicas' shards are done: their parameters and buffers stay as they are)
+                for key, param, grad in zip(keys, stacked, grads):
+                    step_mask = active.view((-1,) + (1,) * (param.dim() - 1)).to(param.dtype)
+
+                    if self.momentum != 0:
+                        if momentum_buffers[key] is None:
+                            momentum_buffers[key] = grad * step_mask
+                        else:
+                            momentum_buffers[key] = torch.where(step_mask.bool(), momentum_buffers[key] * self.momentum + grad, momentum_buffers[key])
+                        grad = momentum_buffers[key]
+
+                    param.sub_(grad * step_mask, alpha=self.lr)
+
+            for param in stacked:
+                param.grad = None
+
+        return True
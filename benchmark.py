@@ -0,0 +1,395 @@
+import os, re, sys, time, json, socket, argparse, itertools, functools, subprocess, platform, threading, multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import utils
+from utils import DEBUG_LEVEL, TERM, Communication_Handler
+from instrumentation import RECORDER
+
+import server
+import client
+import server_trainer
+import client_trainer
+import simulation
+import update_codec
+import cpu_profile
+import secure_aggregation
+import server_optimizer
+from batched_trainer import BatchedTrainer
+
+debug_level = DEBUG_LEVEL.INFO
+
+RESULTS_PATH = './benchmarks/results.jsonl'
+
+# Transports: sockets over loopback, loopback with the weights in shared memory,
+# a pool of simulation workers (shared memory), or every client in the server's process
+TRANSPORTS = ['loopback', 'shm', 'pool', 'inprocess']
+
+### Models ###
+
+# MLP on MNIST inputs whose size is set by its width and depth (for sweeping the model size)
+class SyntheticNet(nn.Module):
+    def __init__(self, width=1024, depth=2):
+        super(SyntheticNet, self).__init__()
+
+        layers = [nn.Flatten(), nn.Linear(28 * 28, width), nn.ReLU()]
+        for _ in range(depth - 1):
+            layers += [nn.Linear(width, width), nn.ReLU()]
+        layers.append(nn.Linear(width, 10))
+
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.layers(x)
+
+# Model builder by name: 'net' (model1.Net, returns None) or 'mlp<width>x<depth>' (e.g. 'mlp1024x4')
+def make_model_fn(spec):
+    if spec == 'net':
+        return None
+
+    match = re.fullmatch(r'mlp(\d+)x(\d+)', spec)
+    if match is None:
+        raise ValueError('Unknown model \'{}\''.format(spec))
+
+    return functools.partial(SyntheticNet, int(match.group(1)), int(match.group(2)))
+
+# Keep the benchmarked components quiet
+def quiet():
+    for module in [server, client, server_trainer, client_trainer, simulation, secure_aggregation]:
+        module.debug_level = DEBUG_LEVEL.ERRORS
+
+### Clients (one process each) ###
+
+def run_client(server_addr, indices, model, codec, epochs, seed, cpu, secure, proximal_mu):
+    quiet()
+    torch.manual_seed(seed)
+
+    trainer = client_trainer.ClientTrainer(None, use_cuda=False, codec=update_codec.make_codec(codec), indices=indices, name='Bench{}'.format(seed),
+                                           eval_every=0, model_fn=make_model_fn(model), cpu_profile=cpu_profile.make_profile(cpu))
+    trainer.num_epochs = epochs
+    trainer.proximal_mu = proximal_mu
+
+    flClient = client.FLClient(server_addr, trainer)
+    if secure:
+        flClient.secure_aggregation = secure_aggregation.SecureAggregationClient(flClient.session)
+    flClient.connect(60)
+
+### Single Run ###
+
+# Run one configuration in this process and measure it
+def run_benchmark(config):
+    quiet()
+    torch.manual_seed(config['seed'])
+
+    model_fn = make_model_fn(config['model'])
+    partitions = simulation.make_partitions('iid', config['clients'], config['seed'])
+
+    trainer = server_trainer.ServerTrainer(use_cuda=False, model_fn=model_fn, eval_subset=config['eval_subset'])
+    trainer.csv_path = None
+    trainer.optimizer = server_optimizer.make_optimizer(config['server_opt'])
+
+    client_procs = []
+    if config['transport'] in ('pool', 'inprocess'):
+        num_workers = min(config['clients'], os.cpu_count()) if config['transport'] == 'pool' else 0
+        flServer = simulation.SimulatedFLServer(trainer, partitions, num_workers=num_workers, model_fn=model_fn)
+        flServer.clients_per_task = config['batch_clients']
+    elif config['secure']:
+        flServer = server.SecureFLServer(('127.0.0.1', 0), trainer, config['secure'])
+    else:
+        flServer = server.FLServer(('127.0.0.1', 0), trainer)
+
+    if config['transport'] not in ('pool', 'inprocess'):
+        flServer.shared_memory = config['transport'] == 'shm'
+        flServer.start()
+
+        # one process per client
+        context = multiprocessing.get_context('spawn')
+        server_addr = flServer.listener_sock.getsockname()
+        for client_id, indices in enumerate(partitions):
+            # (each client on its own share of the cores)
+            cpu = 'share{}/{}'.format(client_id, config['clients'])
+            proc = context.Process(target=run_client, args=(server_addr, indices, config['model'], config['codec'], config['epochs'], config['seed'] + client_id, cpu, config['secure'] > 0, config['prox']), daemon=True)
+            proc.start()
+            client_procs.append(proc)
+
+        deadline = time.time() + 120
+        while len(flServer.connected_clients_by_addr) < config['clients'] and time.time() < deadline:
+            time.sleep(0.1)
+
+    flServer.subset_size = config['clients']
+    flServer.num_rounds = config['rounds']
+    flServer.TIMEOUT = config['timeout']
+
+    RECORDER.events.clear()
+    start = time.time()
+    try:
+        flServer.train()
+    finally:
+        elapsed = time.time() - start
+
+        for proc in client_procs:
+            proc.terminate()
+        if isinstance(flServer, simulation.SimulatedFLServer):
+            flServer.close()
+        elif flServer.publisher is not None:
+            flServer.publisher.close()
+
+    return dict(config, **summarize(list(RECORDER.events), start, elapsed, trainer.layout.numel, config['target']))
+
+# Metrics of a run from the recorded events
+def summarize(events, start, elapsed, numel, target):
+    spans = [event for event in events if event[0] == 'span']
+    round_times = [duration for kind, name, round_idx, begin, duration, thread, args in spans if name == 'round']
+
+    # bytes the server sent and received (the broadcasts' serializations are counted once per client)
+    bytes_sent = sum(args['bytes_sent'] for kind, name, round_idx, begin, duration, thread, args in spans if name == 'broadcast')
+    bytes_received = sum(args['bytes_received'] for kind, name, round_idx, begin, duration, thread, args in spans if name == 'recv')
+
+    # accuracy over time (background evaluations finish before train returns)
+    evaluations = sorted((begin + duration - start, args['accuracy'], args.get('round')) for kind, name, round_idx, begin, duration, thread, args in spans if name == 'evaluate')
+    reached = [(seconds, evaluated_round) for seconds, accuracy, evaluated_round in evaluations if target is not None and accuracy >= target]
+
+    num_rounds = max(1, len(round_times))
+    return {
+        'numel' : numel,
+        'elapsed' : elapsed,
+        'rounds_completed' : len(round_times),
+        'rounds_per_sec' : len(round_times) / elapsed if elapsed > 0 else None,
+        'round_p50' : float(np.percentile(round_times, 50)) if round_times else None,
+        'round_p99' : float(np.percentile(round_times, 99)) if round_times else None,
+        'bytes_sent_per_round' : bytes_sent / num_rounds,
+        'bytes_received_per_round' : bytes_received / num_rounds,
+        'final_accuracy' : evaluations[-1][1] if evaluations else None,
+        'time_to_target' : reached[0][0] if reached else None,
+        'rounds_to_target' : reached[0][1] if reached else None,
+        'server_peak_rss' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) if resource is not None else None,
+    }
+
+### Micro Benchmarks ###
+
+# Message round trips over a loopback socket pair (Communication_Handler)
+def bench_transport(numel, iterations=20):
+    sender, receiver = socket.socketpair()
+    msg = { 'update' : torch.randn(numel), 'num_samples' : 1 }
+
+    def send():
+        for _ in range(iterations):
+            Communication_Handler.send_msg(sender, msg)
+
+    thread = threading.Thread(target=send)
+    start = time.time()
+    thread.start()
+    for _ in range(iterations):
+        Communication_Handler.recv_msg(receiver)
+    thread.join()
+    elapsed = time.time() - start
+
+    sender.close()
+    receiver.close()
+    return { 'bench' : 'transport', 'numel' : numel, 'msgs_per_sec' : iterations / elapsed, 'mb_per_sec' : iterations * numel * 4 / elapsed / 1e6 }
+
+# Batched (aggregate) and streaming (accumulate + finalize) averaging of updates (ServerTrainer)
+def bench_aggregate(model, num_updates, iterations=5):
+    trainer = server_trainer.ServerTrainer(use_cuda=False, async_eval=False, model_fn=make_model_fn(model))
+    updates = [trainer.flat_state() + torch.randn(trainer.layout.numel) for _ in range(num_updates)]
+    weights = [float(i + 1) for i in range(num_updates)]
+
+    start = time.time()
+    for _ in range(iterations):
+        trainer.aggregate(updates, weights)
+    batched = (time.time() - start) / iterations
+
+    start = time.time()
+    for _ in range(iterations):
+        for update, weight in zip(updates, weights):
+            trainer.accumulate(update, weight)
+        trainer.finalize_aggregation()
+    streaming = (time.time() - start) / iterations
+
+    return { 'bench' : 'aggregate', 'model' : model, 'numel' : trainer.layout.numel, 'updates' : num_updates, 'aggregate_sec' : batched, 'streaming_sec' : streaming }
+
+# K clients' local training: one after another (ClientTrainer) and as one batched model (BatchedTrainer),
+# on one thread as in a simulation worker
+def bench_batched(model, num_clients, seed=0):
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+
+    partitions = simulation.make_partitions('iid', num_clients, seed)
+    trainers = [client_trainer.ClientTrainer(None, use_cuda=False, indices=indices, name='Bench{}'.format(i), eval_every=0, model_fn=make_model_fn(model))
+                for i, indices in enumerate(partitions)]
+    weights = trainers[0].layout.flatten(trainers[0].model.state_dict())
+
+    try:
+        for trainer in trainers:
+            trainer.load_weights(weights)
+        start = time.time()
+        for trainer in trainers:
+            trainer.train()
+        sequential = time.time() - start
+
+        for trainer in trainers:
+            trainer.load_weights(weights)
+        start = time.time()
+        BatchedTrainer(trainers).train()
+        batched = time.time() - start
+    finally:
+        torch.set_num_threads(threads)
+
+    epochs = num_clients * trainers[0].num_epochs
+    return { 'bench' : 'batched', 'model' : model, 'numel' : trainers[0].layout.numel, 'clients' : num_clients, 'sequential_sec' : sequential, 'batched_sec' : batched,
+             'client_epochs_per_sec' : epochs / batched, 'speedup' : sequential / batched }
+
+# Secure aggregation against the plain running sum: a client's masking, and the server's unmasking
+# (with one client of every group dropping out, so the dropout recovery is included)
+def bench_secure(model, num_clients, group_size):
+    trainer = server_trainer.ServerTrainer(use_cuda=False, async_eval=False, model_fn=make_model_fn(model))
+    updates = [trainer.flat_state() + torch.randn(trainer.layout.numel) for _ in range(num_clients)]
+
+    start = time.time()
+    for update in updates:
+        trainer.accumulate(update, 1.0)
+    trainer.finalize_aggregation()
+    plain = time.time() - start
+
+    clients = [secure_aggregation.SecureAggregationClient('{:08d}'.format(i)) for i in range(num_clients)]
+    groups = secure_aggregation.make_groups([secure_client.member_id for secure_client in clients], group_size)
+    aggregator = secure_aggregation.SecureAggregator(1, groups, trainer.layout.numel + 1)
+
+    start = time.time()
+    for group in groups:
+        msg = { 'control' : 'secagg_group', 'round' : 1, 'members' : [(member, clients[int(member)].public_key) for member in group] }
+        for member in group:
+            clients[int(member)].handle(msg)
+    key_agreement = time.time() - start
+
+    dropped = set(group[-1] for group in groups if len(group) > secure_aggregation.threshold(len(group)))
+    start = time.time()
+    masked = [secure_client.mask(update, 1) for secure_client, update in zip(clients, updates)]
+    mask = (time.time() - start) / num_clients
+
+    start = time.time()
+    for secure_client, update in zip(clients, masked):
+        if secure_client.member_id not in dropped:
+            aggregator.add(secure_client.member_id, update)
+    for member, msg in aggregator.unmask_requests().items():
+        aggregator.reveal(member, clients[int(member)].handle(msg))
+    aggregator.finalize()
+    unmask = time.time() - start
+
+    return { 'bench' : 'secure', 'model' : model, 'numel' : trainer.layout.numel, 'clients' : num_clients, 'group_size' : group_size, 'dropped' : len(dropped),
+             'plain_sec' : plain, 'key_agreement_sec' : key_agreement, 'mask_sec_per_client' : mask, 'secure_sec' : unmask }
+
+### Sweep ###
+
+# Host and code version the results were measured on
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    return { 'time' : time.time(), 'commit' : commit, 'python' : platform.python_version(), 'torch' : torch.__version__,
+             'platform' : platform.platform(), 'cpus' : os.cpu_count() }
+
+# Run a configuration in a fresh process (so peak RSS is the run's own)
+def run_isolated(config, timeout):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', json.dumps(config)], capture_output=True, text=True, timeout=timeout)
+
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+
+    TERM.write_failure('Run failed: {}'.format(proc.stderr.strip().splitlines()[-1:] or proc.returncode))
+    return dict(config, error=proc.returncode)
+
+def save_results(results, file_path):
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(file_path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+
+def csv_list(cast=str):
+    return lambda value: [cast(item) for item in value.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark FL rounds end to end (and the transport and aggregation on their own).')
+    parser.add_argument('--clients', type=csv_list(int), default=[2, 4])
+    parser.add_argument('--models', type=csv_list(), default=['net', 'mlp1024x2'])
+    parser.add_argument('--codecs', type=csv_list(), default=['full', 'int8'])
+    parser.add_argument('--transports', type=csv_list(), default=TRANSPORTS)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--target', type=float, default=90.0, help='target test accuracy (percent)')
+    parser.add_argument('--eval-subset', type=int, default=2000)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--batch-clients', type=csv_list(int), default=[1], help='clients trained together as one batched model (simulated transports)')
+    parser.add_argument('--secure', type=csv_list(int), default=[0], help='secure aggregation group sizes (0 sends the updates in the clear; socket transports)')
+    parser.add_argument('--server-opts', type=lambda value: value.split(';'), default=['avg'], help='server optimizers, separated by \';\' (e.g. \'avg;avgm;adam,lr=0.01\')')
+    parser.add_argument('--prox', type=csv_list(float), default=[0.0], help='FedProx weights of the clients\' proximal term (socket transports)')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--micro', action='store_true', help='also run the transport and aggregation micro benchmarks')
+    parser.add_argument('--out', default=RESULTS_PATH)
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # (a single configuration, in its own process)
+    if args.run is not None:
+        print('RESULT ' + json.dumps(run_benchmark(json.loads(args.run))))
+        sys.exit(0)
+
+    env = environment()
+    results = []
+
+    if args.micro:
+        for model in args.models:
+            numel = server_trainer.ServerTrainer(use_cuda=False, async_eval=False, model_fn=make_model_fn(model)).layout.numel
+            results.append(dict(bench_transport(numel), model=model, kind='micro', **env))
+            for num_clients in args.clients:
+                results.append(dict(bench_aggregate(model, num_clients), kind='micro', **env))
+                for group_size in args.secure:
+                    if group_size > 0:
+                        results.append(dict(bench_secure(model, num_clients, group_size), kind='micro', **env))
+            for batch_clients in args.batch_clients:
+                if batch_clients > 1:
+                    result = bench_batched(model, batch_clients, args.seed)
+                    results.append(dict(result, kind='micro', **env))
+                    TERM.write('\t{} clients batched: {:0.2f}s vs {:0.2f}s one after another ({:0.1f}x)'.format(batch_clients, result['batched_sec'], result['sequential_sec'], result['speedup']))
+
+    for num_clients, model, codec, transport, batch_clients, secure, server_opt, prox, repeat in itertools.product(args.clients, args.models, args.codecs, args.transports, args.batch_clients,
+                                                                                                                args.secure, args.server_opts, args.prox, range(args.repeats)):
+        # (simulated clients always send their full weights; only they can be batched)
+        if transport in ('pool', 'inprocess') and codec != 'full':
+            continue
+        if transport not in ('pool', 'inprocess') and batch_clients != 1:
+            continue
+        # (masked updates are full weights, sent over sockets)
+        if secure > 0 and (transport in ('pool', 'inprocess') or codec != 'full'):
+            continue
+        if prox > 0 and transport in ('pool', 'inprocess'):
+            continue
+
+        config = { 'clients' : num_clients, 'model' : model, 'codec' : codec, 'transport' : transport, 'batch_clients' : batch_clients, 'secure' : secure, 'server_opt' : server_opt, 'prox' : prox, 'rounds' : args.rounds, 'epochs' : args.epochs,
+                   'target' : args.target, 'eval_subset' : args.eval_subset, 'timeout' : args.timeout, 'seed' : args.seed + repeat }
+
+        TERM.write_info('Benchmarking {} client(s), {}, {}, {}, server {}{}{}...'.format(num_clients, model, codec, transport, server_opt,
+                                                                                  ', prox {}'.format(prox) if prox else '', ', secure groups of {}'.format(secure) if secure else ''))
+        result = run_isolated(config, timeout=args.timeout * (args.rounds + 1))
+        results.append(dict(result, kind='e2e', **env))
+
+        if 'error' not in result and result['rounds_completed'] > 0:
+            TERM.write('\t{:0.2f} rounds/s, p50 {:0.3f}s, p99 {:0.3f}s, {:0.0f} bytes/round, peak RSS {:0.0f} MB'.format(
+                result['rounds_per_sec'], result['round_p50'], result['round_p99'], result['bytes_sent_per_round'] + result['bytes_received_per_round'], result['server_peak_rss'] / 2**20))
+
+    save_results(results, args.out)
+    TERM.write_success('{} result(s) appended to {}'.format(len(results), args.out))
@@ -0,0 +1,127 @@
+import os, sys, re, json, time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+
+debug_level = DEBUG_LEVEL.INFO
+
+CHECKPOINT_DIR = './checkpoints'
+
+# Write a file atomically (readers see either the old file or the complete new one)
+def write_atomic(path, write):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Versioned store of the global (flat) weights, their round metadata and (optionally) named state buffers (e.g. the server optimizer's).
+# Versions are written in the background (in order) and only the latest `retain` are kept.
+class CheckpointStore():
+    def __init__(self, directory=CHECKPOINT_DIR, every=1, retain=3):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # Save every N versions, keeping the latest few
+        self.every = every
+        self.retain = retain
+
+        # Single writer thread (keeps versions in order)
+        self.write_pool = ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = []
+
+    def weights_path(self, version):
+        return os.path.join(self.directory, 'model{:08d}.npy'.format(version))
+
+    def metadata_path(self, version):
+        return os.path.join(self.directory, 'model{:08d}.json'.format(version))
+
+    def state_path(self, version):
+        return os.path.join(self.directory, 'model{:08d}.state.npz'.format(version))
+
+    ### Saving ###
+
+    # Whether the given version is due for a checkpoint
+    def should_save(self, version):
+        return self.every > 0 and version % self.every == 0
+
+    # Snapshot the weights (and state buffers) and write them with their metadata in the background
+    def save(self, version, flat_weights, metadata=None, state=None):
+        snapshot = flat_weights.detach().to('cpu', torch.float32, copy=True).numpy()
+        state = { name : buffer.detach().to('cpu', copy=True).numpy() for name, buffer in (state or {}).items() }
+        metadata = dict(metadata or {}, version=version, time=time.time(), numel=int(snapshot.size))
+
+        self.pending_writes = [future for future in self.pending_writes if not future.done()]
+        self.pending_writes.append(self.write_pool.submit(self.write, version, snapshot, metadata, state))
+
+    # Write a version: weights and state first, then the metadata (which marks the version complete)
+    def write(self, version, weights, metadata, state=None):
+        try:
+            write_atomic(self.weights_path(version), lambda f: np.save(f, weights))
+            if state:
+                write_atomic(self.state_path(version), lambda f: np.savez(f, **state))
+            write_atomic(self.metadata_path(version), lambda f: f.write(json.dumps(metadata).encode()))
+        except OSError:
+            TERM.write_failure('Checkpoint {}: Write Error \'{}\''.format(version, sys.exc_info()[1]))
+            return
+
+        if debug_level >= DEBUG_LEVEL.ALL:
+            TERM.write('\tCheckpoint {} saved.'.format(version))
+
+        self.evict()
+
+    # Remove all but the latest `retain` versions
+    def evict(self):
+        for version in self.versions()[:-self.retain] if self.retain > 0 else []:
+            for path in [self.metadata_path(version), self.weights_path(version), self.state_path(version)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # Wait until every checkpoint has been written
+    def wait(self):
+        pending, self.pending_writes = self.pending_writes, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.write_pool.shutdown()
+
+    ### Loading ###
+
+    # Complete versions (oldest first)
+    def versions(self):
+        versions = []
+        for file_name in os.listdir(self.directory):
+            match = re.fullmatch(r'model(\d+)\.json', file_name)
+            if match is not None and os.path.exists(self.weights_path(int(match.group(1)))):
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    # Latest complete version (None if there is none)
+    def latest(self):
+        versions = self.versions()
+        return versions[-1] if len(versions) > 0 else None
+
+    def metadata(self, version):
+        with open(self.metadata_path(version)) as f:
+            return json.load(f)
+
+    # The flat weights of a version, memory-mapped (copy on write: nothing is read until used)
+    def load(self, version):
+        return torch.from_numpy(np.load(self.weights_path(version), mmap_mode='c'))
+
+    # The state buffers saved with a version (None if it has none)
+    def load_state(self, version):
+        if not os.path.exists(self.state_path(version)):
+            return None
+
+        with np.load(self.state_path(version)) as arrays:
+            return { name : torch.from_numpy(arrays[name]) for name in arrays.files }
@@ -1,53 +1,127 @@
-import time, sys, multiprocessing, errno, socket
+import time, sys, multiprocessing, errno, socket, select, random, threading, uuid, atexit
 
 import utils
 from utils import DEBUG_LEVEL, TERM, Communication_Handler
+from instrumentation import RECORDER
 
 import client_trainer
+import update_codec
+import cpu_profile
+import precision
+import secure_aggregation
 
 debug_level = DEBUG_LEVEL.INFO
 
 class Client():
     def __init__(self, server, name = None):
-        # Socket for communication
+        # Socket for communication (a new one per connection attempt)
         self.server = server
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock = None
         self.connected = False
 
         self.name = 'anon_client' if not name else name
 
+        # Session (kept across reconnects, so the server recognizes this client)
+        self.session = uuid.uuid4().hex
+
+        # Heartbeats share the socket with the training loop
+        self.send_lock = threading.Lock()
+        self.heartbeat_thread = None
+        self.HEARTBEAT_INTERVAL = 5
+
+        # Reconnection backoff (seconds)
+        self.MIN_BACKOFF = 0.1
+        self.MAX_BACKOFF = 5
+        self.RECONNECT_TIMEOUT = 60
+
     # Attempt to connect to the Server.
     def attempt_to_connect(self, TIMEOUT):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         try:
             # Connect socket
-            self.sock.connect(self.server)
+            sock.connect(self.server)
+            self.sock = sock
             self.connected = True
-        except:
+        except OSError:
+            sock.close()
             self.connected = False
 
-    def connect(self, TIMEOUT):
-        if debug_level >= DEBUG_LEVEL.INFO:
-            TERM.write_info('Attempting to connect to {} (Timeout: {}s)'.format(self.server, TIMEOUT))
-
-        # Retry to connect to the server
+    # Retry to connect (with exponential backoff and jitter) and introduce this client's session
+    def open_connection(self, TIMEOUT):
         start = time.time()
+        backoff = self.MIN_BACKOFF
 
-        while (time.time() - start) < TIMEOUT:
+        self.attempt_to_connect(TIMEOUT)
+        while not self.connected:
+            remaining = TIMEOUT - (time.time() - start)
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(remaining, random.uniform(0.5, 1.0) * backoff))
+            backoff = min(2 * backoff, self.MAX_BACKOFF)
             self.attempt_to_connect(TIMEOUT)
 
-            if self.connected:
-                break
+        self.send(self.hello_msg())
+
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self.send_heartbeats, daemon=True)
+            self.heartbeat_thread.start()
+
+        return True
+
+    def connect(self, TIMEOUT):
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_info('Attempting to connect to {} (Timeout: {}s)'.format(self.server, TIMEOUT))
 
         # Run the client (if connection succesful)
-        if not self.connected:
+        if not self.open_connection(TIMEOUT):
             if debug_level >= DEBUG_LEVEL.INFO:
-                TERM.write_failure('Time limit exceeded: {} not found'.format(SERVER))
+                TERM.write_failure('Time limit exceeded: {} not found'.format(self.server))
         else:
             if debug_level >= DEBUG_LEVEL.INFO:
-                TERM.write_success('Successfully connected to {} as {}'.format(SERVER, self.sock.getsockname()))
+                TERM.write_success('Successfully connected to {} as {}'.format(self.server, self.sock.getsockname()))
             self.run()
 
+    # Replace a lost connection (same session), returning whether it succeeded
+    def reconnect(self):
+        if debug_level >= DEBUG_LEVEL.WARNS:
+            TERM.write_warning('Connection to {} lost: reconnecting (Timeout: {}s)...'.format(self.server, self.RECONNECT_TIMEOUT))
+
+        with self.send_lock:
+            self.connected = False
+            if self.sock is not None:
+                self.sock.close()
+
+        if not self.open_connection(self.RECONNECT_TIMEOUT):
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_failure('Time limit exceeded: {} not found'.format(self.server))
+            return False
+
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_success('Reconnected to {} as {}'.format(self.server, self.sock.getsockname()))
+        return True
+
+    # Introduction sent on each (re)connection
+    def hello_msg(self):
+        return Communication_Handler.hello_msg(self.session, self.cached_version())
+
+    # Model version this client holds (reported to the server, which sends diffs against it)
+    def cached_version(self):
+        return None
+
+    # Send a message to the server (serialized with the heartbeats)
+    def send(self, msg):
+        with self.send_lock:
+            return self.connected and Communication_Handler.send_msg(self.sock, msg)
+
+    # Let the server know this client is alive (even while it trains)
+    def send_heartbeats(self):
+        while True:
+            time.sleep(self.HEARTBEAT_INTERVAL)
+            self.send(Communication_Handler.HEARTBEAT_MSG)
+
 
 # Handles FL Client training loop logic
 class FLClient(Client):
@@ -58,6 +132,12 @@ class FLClient(Client):
         self.trainer = trainer
         self.TIMEOUT = 100000000000
 
+        # Secure aggregation (None sends the updates in the clear)
+        self.secure_aggregation = None
+
+        # A message read while checking for a cancellation (handled by the training loop next)
+        self.pending_msg = None
+
     ### FL Training Loop ###
 
     def run(self):
@@ -66,38 +146,122 @@ class FLClient(Client):
             if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write_info('Waiting for model from server...(Timeout: ' + str(self.TIMEOUT) + ')')
 
-                start_time = time.time()
-                weights = None
-                while ((weights == None) and (time.time() - start_time < self.TIMEOUT)):
-                    # get the weights.
+            start_time = time.time()
+            weights = None
+            while ((weights is None) and (time.time() - start_time < self.TIMEOUT)):
+                # get the weights (ignoring cancellations of updates that were already sent).
+                wait_start = time.time()
+                if self.pending_msg is not None:
+                    download_start = wait_start
+                    weights, self.pending_msg = self.pending_msg, None
+                else:
+                    select.select([self.sock], [], [])
+                    download_start = time.time()
                     weights = Communication_Handler.recv_msg(self.sock)
+                download_time = time.time() - download_start
 
-                if weights == None:
-                    if debug_level >= DEBUG_LEVEL.INFO:
-                        TERM.write_warning("Time Limit Exceeded: Weights not received.")
-                else:
-                    if debug_level >= DEBUG_LEVEL.INFO:
-                        TERM.write_success("Weights received.")
-                        TERM.write_info("Training local model...")
+                RECORDER.record('wait_for_model', wait_start, download_start - wait_start)
 
-                    # Load weights
-                    self.trainer.load_weights(weights)
+                # (the server went away: rejoin it with the same session)
+                if weights is None and not self.reconnect():
+                    return
 
-                    # Train model
-                    self.trainer.train()
+                if Communication_Handler.control_msg(weights) is not None:
+                    self.handle_control(weights)
+                    weights = None
 
-                    if debug_level >= DEBUG_LEVEL.INFO:
-                        TERM.write_success("Training complete.")
-                        TERM.write_info("Sending update to server...")
+            if weights is None:
+                if debug_level >= DEBUG_LEVEL.INFO:
+                    TERM.write_warning("Time Limit Exceeded: Weights not received.")
+            else:
+                if debug_level >= DEBUG_LEVEL.INFO:
+                    TERM.write_success("Weights received.")
+                    TERM.write_info("Training local model...")
 
-                    # Compute focused update
-                    update = self.trainer.focused_update()
+                # Load weights (a diff against a version this client doesn't hold, or weights no longer published in shared memory:
+                # sit the round out, the server then sends the weights again)
+                if not self.trainer.load_weights(weights):
+                    if debug_level >= DEBUG_LEVEL.WARNS:
+                        TERM.write_warning("Model could not be loaded: dropping this round.")
+                    self.send(Communication_Handler.cancelled_msg(self.cached_version()))
+                    continue
+                RECORDER.set_round(self.trainer.received_round)
 
-                    # Send update to the server
-                    Communication_Handler.send_msg(self.sock, update)
+                # Train model
+                self.trainer.train()
 
+                if debug_level >= DEBUG_LEVEL.INFO:
+                    TERM.write_success("Training complete.")
+                    TERM.write_info("Sending update to server...")
+
+                # Don't send an update the server has cancelled (its round is over)
+                if self.update_cancelled():
                     if debug_level >= DEBUG_LEVEL.INFO:
-                        TERM.write_success("Update sent.")
+                        TERM.write_warning("Update cancelled by the server.")
+                    self.send(Communication_Handler.cancelled_msg(self.cached_version()))
+                    continue
+
+                # Compute focused update
+                update = self.trainer.focused_update()
+                num_samples = self.trainer.num_samples
+
+                # (masked: the server only learns the sum of the group's updates and sample counts)
+                if self.secure_aggregation is not None:
+                    update, num_samples = self.secure_aggregation.mask(update, num_samples), 1
+                    if update is None:
+                        if debug_level >= DEBUG_LEVEL.WARNS:
+                            TERM.write_warning("No secure aggregation group for this round: dropping the update.")
+                        self.send(Communication_Handler.cancelled_msg(self.cached_version()))
+                        continue
+
+                # Send update to the server (weighted by the number of local samples)
+                # (with the timings and loss used by the server's client selection)
+                stats = { 'download' : download_time, 'train' : self.trainer.last_train_time, 'loss' : self.trainer.last_loss }
+                if not self.send({ 'update' : update, 'num_samples' : num_samples, 'stats' : stats, 'version' : self.cached_version() }):
+                    if not self.reconnect():
+                        return
+                    continue
+
+                RECORDER.record('round', download_start, time.time() - download_start, { 'samples' : self.trainer.num_samples })
+                RECORDER.record_memory()
+
+                if debug_level >= DEBUG_LEVEL.INFO:
+                    TERM.write_success("Update sent.")
+
+    def cached_version(self):
+        return self.trainer.model_receiver.version
+
+    def hello_msg(self):
+        msg = super(FLClient, self).hello_msg()
+        if self.secure_aggregation is not None:
+            msg['public_key'] = self.secure_aggregation.public_key
+        return msg
+
+    # Control messages between rounds (cancellations of updates that were already sent are ignored)
+    def handle_control(self, msg):
+        if self.secure_aggregation is None:
+            return
+
+        reply = self.secure_aggregation.handle(msg)
+        if reply is not None:
+            self.send(reply)
+
+    # Whether the server cancelled the update being computed (without blocking);
+    # any other message (e.g. the next model) is kept for the training loop
+    def update_cancelled(self):
+        if self.pending_msg is not None:
+            return False
+
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+
+        msg = Communication_Handler.recv_msg(self.sock)
+        if Communication_Handler.control_msg(msg) == 'cancel':
+            return True
+
+        self.pending_msg = msg
+        return False
 
 ### Main Code ###
 
@@ -110,6 +274,42 @@ if __name__ == '__main__':
     idx = int(sys.argv[1])
     nums = [[3, 5, 7, 9], [0, 1, 8], [2, 4, 6]]
 
+    # Optional update codec (e.g. 'int8', 'topk0.01+int8'), server (e.g. --server=localhost:8081 for an edge aggregator)
+    # CPU profile (e.g. --cpu=share0/4 for the first of 4 clients on this host, or --cpu=threads=2,cores=0-1,prefetch=2)
+    # precision mode (e.g. --precision=bf16+channels_last), secure aggregation (--secure, full weights only)
+    # FedProx (e.g. --prox=0.01, the weight of the proximal term) and the trace buffer size (e.g. --trace-events=1000000)
+    codec = None
+    profile = None
+    precision_mode = None
+    secure = False
+    proximal_mu = 0.0
+    for arg in sys.argv[2:]:
+        if arg.startswith('--server='):
+            host, port = arg.split('=', 1)[1].rsplit(':', 1)
+            SERVER = (socket.gethostbyname(host), int(port))
+        elif arg == '--secure':
+            secure = True
+        elif arg.startswith('--prox='):
+            proximal_mu = float(arg.split('=', 1)[1])
+        elif arg.startswith('--trace-events='):
+            RECORDER.set_capacity(int(arg.split('=', 1)[1]))
+        elif arg.startswith('--cpu='):
+            profile = cpu_profile.make_profile(arg.split('=', 1)[1])
+        elif arg.startswith('--precision='):
+            precision_mode = precision.make_precision(arg.split('=', 1)[1])
+        else:
+            codec = update_codec.make_codec(arg)
+
+    # Where each round's time went (written on exit: JSON lines, and a Chrome trace).
+    atexit.register(RECORDER.export, './train_curves/Client{}_trace'.format(idx))
+
     # Instantiate FL client with Training program
-    client = FLClient(SERVER, client_trainer.ClientTrainer(nums[idx]))
+    if secure and codec is not None:
+        TERM.write_warning('Masked updates are full weights: ignoring the update codec.')
+        codec = None
+
+    client = FLClient(SERVER, client_trainer.ClientTrainer(nums[idx], codec=codec, cpu_profile=profile, precision=precision_mode))
+    client.trainer.proximal_mu = proximal_mu
+    if secure:
+        client.secure_aggregation = secure_aggregation.SecureAggregationClient(client.session)
     client.connect(5)
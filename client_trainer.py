@@ -7,6 +7,12 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 
 import model1
+import data_prep
+from flat_params import FlatLayout
+import update_codec
+import evaluation
+import shm_transport
+import model_cache
 
 import matplotlib
 from matplotlib import pyplot as plt
@@ -15,137 +21,202 @@ import numpy as np
 
 import utils
 from utils import DEBUG_LEVEL, TERM
+from instrumentation import RECORDER
 
 debug_level = DEBUG_LEVEL.INFO
 
 class ClientTrainer():
-    def __init__(self, local_client_digits, use_cuda=True):
+    def __init__(self, local_client_digits, use_cuda=True, codec=None, indices=None, name=None, eval_every=1, model_fn=None, cpu_profile=None, precision=None, eval_subset=2000):
         # Hyperparameters
         self.num_epochs = 2
         self.lr = 1e-3
         self.momentum = 0.9
         self.batch_size = 164    #4
 
+        # FedProx: weight of the proximal term mu/2 * ||w - w_received||^2 (0 trains plain SGD)
+        self.proximal_mu = 0.0
+
         # EXTRA: Cache digits part of this client's dataset
         self.digits = local_client_digits
+        self.name = str(local_client_digits) if name is None else name
 
-        composition = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5,), (0.5,))])
+        # Load this client's MNIST shard (from the preprocessed, memory-mapped cache)
+        # (either the given digits, or explicit sample indices)
+        data_prep.prepare_mnist()
 
-        # Load MNIST dataset
-        train_set = torchvision.datasets.MNIST(root='./data', train=True, download=True, transform=composition)
-        test_set = torchvision.datasets.MNIST(root='./data', train=False, download=True, transform=composition)
+        self.train_loader = data_prep.ShardLoader('train', digits=local_client_digits, batch_size=self.batch_size, shuffle=True, indices=indices)
+        self.test_loader = data_prep.ShardLoader('test', shuffle=False)
 
-        # Select relevant subset of samples
-        indices = (train_set.targets[..., None] == torch.tensor(local_client_digits)).any(-1).nonzero().squeeze() # Equivalent to np.isin()
+        self.num_samples = self.train_loader.num_samples
 
-        train_set.data = train_set.data[indices]
-        train_set.targets = train_set.targets[indices]
+        # Evaluation: test accuracy every N epochs on a fixed random subset (training accuracy comes from the forward passes)
+        # (eval_every = 0 disables testing, and skips caching the test tensors; both are read once, when the evaluator is built)
+        self.eval_every = eval_every
+        self.eval_subset = eval_subset
+        self.evaluator = evaluation.Evaluator(self.test_loader, every=self.eval_every, subset=self.eval_subset) if self.eval_every > 0 else None
+        self.train_accuracy = evaluation.RunningAccuracy()
 
-        # Wrap in DataLoader
-        self.train_loader = DataLoader(train_set, batch_size=self.batch_size, shuffle=True)
-        self.test_loader = DataLoader(test_set, batch_size=len(test_set.targets), shuffle=False)
+        # Stats of the last local training (for client selection)
+        self.last_train_time = None
+        self.last_loss = None
 
-        # Instantiate model
-        self.model = model1.Net()
+        # Instantiate model (model_fn builds another architecture, e.g. for benchmarks)
+        self.model = model1.Net() if model_fn is None else model_fn()
 
-        # Enable CUDA
+        # Enable CUDA (decided once)
         self.use_cuda = use_cuda
-        if self.use_cuda and torch.cuda.is_available():
-            self.model = self.model.cuda()
+        self.device = torch.device('cuda' if self.use_cuda and torch.cuda.is_available() else 'cpu')
+        self.model = self.model.to(self.device)
+
+        # Reduced precision mode (None runs in float32); forward_model runs the (float32 master) model
+        self.precision = precision
+        self.forward_model = self.model if self.precision is None else self.precision.prepare(self.model)
+
+        # CPU threads / cores of this client, and background batch preparation
+        self.cpu_profile = cpu_profile
+        if self.cpu_profile is not None:
+            self.cpu_profile.apply()
+            self.train_loader = self.cpu_profile.loader(self.train_loader, self.device)
+
+        # Flat parameter layout (weights travel as a single buffer)
+        self.layout = FlatLayout(self.model.state_dict())
+
+        # Update codec (None sends the full weights)
+        self.codec = codec
+        self.received_weights = None
+
+        # Latest model version received (the server sends diffs against it)
+        self.model_receiver = model_cache.ModelReceiver()
+
+        # Server round of the weights loaded last (None if the message didn't say)
+        self.received_round = None
 
     ### Training Program ###
 
-    # Load weights from server model
+    # Load weights from server model (a state dict, a flat buffer or a versioned model message),
+    # returning whether they could be loaded (a diff against a version this client doesn't hold can't)
     def load_weights(self, weights):
-        self.model.load_state_dict(weights)
+        # Weights published in shared memory (co-located server): map and load them from there
+        if shm_transport.is_notification(weights):
+            loaded = shm_transport.read_weights(weights, self.load_weights)
+            self.received_round = weights.get('round')
+            return loaded
+
+        self.received_round = None
+
+        with RECORDER.span('load_weights'):
+            # Versioned weights (or diffs against the version received last)
+            if model_cache.is_model_msg(weights):
+                weights = self.model_receiver.receive(weights)
+                if weights is None:
+                    return False
+                self.received_round = self.model_receiver.version
 
-    # Compute focused update to send
+            self.model.load_state_dict(self.layout.as_state_dict(weights))
+
+        # Keep the received weights as the base of the next delta
+        if self.codec is not None:
+            self.received_weights = self.layout.flatten(self.model.state_dict())
+
+        return True
+
+    # Compute focused update to send (as a single flat buffer, or encoded by the codec)
     def focused_update(self):
-        return self.model.state_dict()
+        with RECORDER.span('focused_update') as span:
+            weights = self.layout.flatten(self.model.state_dict())
+            update = weights if self.codec is None else self.codec.encode(weights, self.received_weights)
+            span.set(nbytes=update_codec.payload_nbytes(update))
+
+        if self.codec is None:
+            return weights
+
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write('\tUpdate size: {} bytes ({:0.1f}x smaller)'.format(update_codec.payload_nbytes(update), update_codec.payload_nbytes(weights) / max(1, update_codec.payload_nbytes(update))))
+
+        return update
+
+    # Add the proximal term's gradient, mu * (w - w_received), to the parameters' gradients (fused over all of them)
+    def add_proximal_gradient(self, params, anchors):
+        pairs = [(param, anchor) for param, anchor in zip(params, anchors) if param.grad is not None]
+        grads = [param.grad for param, _ in pairs]
+
+        if hasattr(torch, '_foreach_add_'):
+            torch._foreach_add_(grads, [param.detach() for param, _ in pairs], alpha=self.proximal_mu)
+            torch._foreach_add_(grads, [anchor for _, anchor in pairs], alpha=-self.proximal_mu)
+        else:
+            for grad, (param, anchor) in zip(grads, pairs):
+                grad.add_(param.detach(), alpha=self.proximal_mu).sub_(anchor, alpha=self.proximal_mu)
 
     def train(self):
         # Optimization Settings
         criterion = nn.CrossEntropyLoss()
         optimizer = torch.optim.SGD(self.model.parameters(), lr=self.lr, momentum=self.momentum)
 
+        # (the weights training starts from are the received ones, which the proximal term pulls towards)
+        params = [param for param in self.model.parameters() if param.requires_grad]
+        anchors = [param.detach().clone() for param in params] if self.proximal_mu > 0 else None
+
         start = time.time()
 
         for epoch in range(self.num_epochs):
             running_loss = 0.0
+            self.train_accuracy.reset()
 
             for i, (inputs, targets) in enumerate(self.train_loader):
                 # Enable CUDA
-                if self.use_cuda and torch.cuda.is_available():
-                    inputs = inputs.cuda()
-                    targets = targets.cuda()
+                inputs = inputs.to(self.device, non_blocking=True)
+                targets = targets.to(self.device, non_blocking=True)
 
                 # Forward Pass
-                outputs = self.model(inputs)
-                loss = criterion(outputs, targets)
+                if self.precision is None:
+                    outputs = self.forward_model(inputs)
+                    loss = criterion(outputs, targets)
+                else:
+                    with self.precision.autocast(self.device):
+                        outputs = self.forward_model(self.precision.inputs(inputs))
+                        loss = criterion(outputs, targets)
 
                 # Backward Pass
                 loss.backward()
+                if anchors is not None:
+                    self.add_proximal_gradient(params, anchors)
                 optimizer.step()
                 optimizer.zero_grad()
 
-                # Accumulate the loss
+                # Accumulate the loss (and the running training accuracy)
                 running_loss += loss.item()
+                self.train_accuracy.update(outputs, targets)
 
             if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write('\tEpoch ' + str(epoch + 1))
 
-            train_acc_list, train_acc  = self.evaluate_accuracy(self.train_loader)
-            test_acc_list, test_acc = self.evaluate_accuracy(self.test_loader)
+            train_acc_list, train_acc = self.train_accuracy.result()
 
             if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write('\tTraining Accuracy: {0:0.2f}'.format(train_acc))
+
+            if self.evaluator is None or not self.evaluator.should_evaluate(epoch + 1):
+                continue
+
+            with RECORDER.span('evaluate', epoch=epoch + 1):
+                test_acc_list, test_acc = self.evaluator.evaluate(self.forward_model, self.precision)
+
+            if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write('\tTesting Accuracy: {0:0.2f}'.format(test_acc))
 
-            with open('./train_curves/Client{}.csv'.format(self.digits), 'a', newline='') as csv_file:
+            with open('./train_curves/Client{}.csv'.format(self.name), 'a', newline='') as csv_file:
                 writer = csv.writer(csv_file)
                 writer.writerow(test_acc_list)
         end = time.time()
 
-        if debug_level >= DEBUG_LEVEL.INFO:
-            TERM.write('\t%0.2f minutes' %((end - start) / 60))
-
-    ### Helper Functions ###
-
-    def evaluate_accuracy(self, data_loader):
-        # Cache results for each class
-        correct_by_class = torch.zeros(10)
-        total_by_class = torch.zeros(10)
+        # Cache stats reported to the server's scheduler
+        self.last_train_time = end - start
+        self.last_loss = running_loss / max(1, len(self.train_loader))
 
-        # Enable CUDA
-        if self.use_cuda and torch.cuda.is_available():
-            correct_by_class = correct_by_class.cuda()
-            total_by_class = total_by_class.cuda()
-
-        for inputs, targets in data_loader:
-            # Enable CUDA
-            if self.use_cuda and torch.cuda.is_available():
-                inputs = inputs.cuda()
-                targets = targets.cuda()
-
-            # Compute predictions
-            with torch.no_grad():
-                outputs = self.model(inputs)
-
-            preds = outputs.max(1, keepdim=True)[1]
-
-            # determine the number correct per class.
-            labels, counts = torch.unique(targets[(preds.squeeze() == targets).nonzero()], return_counts=True)
-            correct_by_class[labels] += counts.float()
-
-            # determine the number per class.
-            labels, counts = torch.unique(targets, return_counts=True)
-            total_by_class[labels] += counts.float()
-
-        total_by_class[(total_by_class == 0).nonzero()] = 1.0 # TODO: Change this to be an NaN.
-
-        acc = 100 * correct_by_class.sum() / total_by_class.sum()
-        return (correct_by_class / total_by_class).cpu().tolist(), float(acc.cpu())
+        RECORDER.record('train', start, end - start, { 'samples' : self.num_samples, 'epochs' : self.num_epochs, 'loss' : self.last_loss })
 
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write('\t%0.2f minutes' %((end - start) / 60))
 
 # TEST
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import os, queue, threading
+
+import torch
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+
+debug_level = DEBUG_LEVEL.INFO
+
+# How a process uses the host's CPUs: intra-op / inter-op torch threads, the cores it runs on,
+# and how many batches its loaders prepare ahead (so co-located clients don't oversubscribe cores)
+class CPUProfile():
+    def __init__(self, intra_threads=None, inter_threads=None, cores=None, prefetch=0):
+        self.intra_threads = intra_threads
+        self.inter_threads = inter_threads
+        self.cores = None if cores is None else sorted(cores)
+        self.prefetch = prefetch
+
+    # Apply the profile to this process (inter-op threads can only be set before any parallel work)
+    def apply(self):
+        if self.cores is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cores)
+
+        if self.intra_threads is not None:
+            torch.set_num_threads(self.intra_threads)
+
+        if self.inter_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.inter_threads)
+            except RuntimeError:
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('Inter-op threads already in use: keeping {}'.format(torch.get_num_interop_threads()))
+
+        return self
+
+    # Wrap a loader so its batches are prepared in the background
+    def loader(self, data_loader, device=None):
+        if self.prefetch <= 0:
+            return data_loader
+        return PrefetchLoader(data_loader, self.prefetch, device)
+
+    # Share i of n equal shares of the available cores (one per co-located client), one thread per core
+    def share(index, count, prefetch=2):
+        available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        per_share = max(1, len(available) // count)
+        first = (index * per_share) % len(available)
+        cores = available[first:first + per_share]
+
+        return CPUProfile(intra_threads=len(cores), inter_threads=1, cores=cores, prefetch=prefetch)
+
+# Iterates a loader's batches from a background thread (one per pass over the data), up to depth batches ahead
+# (batches bound for a GPU are pinned and copied asynchronously); errors in the thread are raised to the consumer
+class PrefetchLoader():
+    def __init__(self, data_loader, depth=2, device=None):
+        self.data_loader = data_loader
+        self.depth = depth
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    # (the wrapped loader's attributes, e.g. num_samples and batch_size, stay visible)
+    def __getattr__(self, name):
+        return getattr(self.data_loader, name)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stopped = threading.Event()
+        pin = self.device is not None and self.device.type == 'cuda'
+
+        # (gives up once the consumer has stopped iterating, instead of blocking on a full queue forever)
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for inputs, targets in self.data_loader:
+                    if pin:
+                        inputs, targets = inputs.pin_memory(), targets.pin_memory()
+                    if not put((inputs, targets)):
+                        return
+            except BaseException as error:
+                put(error)
+                return
+            put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+
+                inputs, targets = batch
+                if pin:
+                    inputs, targets = inputs.to(self.device, non_blocking=True), targets.to(self.device, non_blocking=True)
+                yield inputs, targets
+        finally:
+            stopped.set()
+
+# Build a profile from a spec: 'share<i>/<n>' (e.g. 'share0/4') or
+# comma separated settings (e.g. 'threads=2,interop=1,cores=0-1,prefetch=2')
+def make_profile(spec):
+    if spec is None:
+        return None
+
+    if spec.startswith('share'):
+        index, count = spec[len('share'):].split('/')
+        return CPUProfile.share(int(index), int(count))
+
+    profile = CPUProfile()
+    for setting in spec.split(','):
+        key, value = setting.split('=', 1)
+        if key == 'threads':
+            profile.intra_threads = int(value)
+        elif key == 'interop':
+            profile.inter_threads = int(value)
+        elif key == 'cores':
+            cores = []
+            for part in value.split('+'):
+                first, _, last = part.partition('-')
+                cores += list(range(int(first), int(last or first) + 1))
+            profile.cores = cores
+        elif key == 'prefetch':
+            profile.prefetch = int(value)
+        else:
+            raise ValueError('Unknown CPU setting \'{}\''.format(key))
+
+    return profile
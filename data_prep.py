@@ -0,0 +1,92 @@
+import os, sys
+
+import numpy as np
+import torch
+import torchvision
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+
+debug_level = DEBUG_LEVEL.INFO
+
+CACHE_DIR = './data/mnist_cache'
+
+### Data Preparation ###
+
+# Save an array atomically (so concurrent clients never see a partial file)
+def save_array(path, array):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+# Decode MNIST once into raw uint8 arrays with per-digit index files
+def prepare_mnist(root='./data', cache_dir=CACHE_DIR):
+    if os.path.exists(os.path.join(cache_dir, 'done')):
+        return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    if debug_level >= DEBUG_LEVEL.INFO:
+        TERM.write_info('Preparing MNIST cache in {}...'.format(cache_dir))
+
+    for split, train in [('train', True), ('test', False)]:
+        dataset = torchvision.datasets.MNIST(root=root, train=train, download=True)
+
+        images = dataset.data.numpy().astype(np.uint8)
+        labels = dataset.targets.numpy().astype(np.uint8)
+
+        save_array(os.path.join(cache_dir, '{}_images.npy'.format(split)), images)
+        save_array(os.path.join(cache_dir, '{}_labels.npy'.format(split)), labels)
+
+        # Index of every sample of each digit
+        for digit in range(10):
+            save_array(os.path.join(cache_dir, '{}_digit{}.npy'.format(split, digit)), np.nonzero(labels == digit)[0].astype(np.int64))
+
+    open(os.path.join(cache_dir, 'done'), 'w').close()
+    return cache_dir
+
+### Data Loading ###
+
+# Iterates normalized batches of a (digit) shard of the memory-mapped cache
+class ShardLoader():
+    def __init__(self, split, digits=None, batch_size=None, shuffle=False, cache_dir=CACHE_DIR, indices=None):
+        # Memory-mapped (shared page cache across clients on one host)
+        self.images = np.load(os.path.join(cache_dir, '{}_images.npy'.format(split)), mmap_mode='r')
+        self.labels = np.load(os.path.join(cache_dir, '{}_labels.npy'.format(split)), mmap_mode='r')
+
+        # Indices of this shard's samples
+        if indices is not None:
+            self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        elif digits is None:
+            self.indices = np.arange(len(self.labels))
+        else:
+            self.indices = np.sort(np.concatenate([np.load(os.path.join(cache_dir, '{}_digit{}.npy'.format(split, digit))) for digit in digits]))
+
+        self.num_samples = len(self.indices)
+        self.batch_size = self.num_samples if batch_size is None else batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = np.random.permutation(self.indices) if self.shuffle else self.indices
+
+        for start in range(0, self.num_samples, self.batch_size):
+            # Gather in sorted order (sequential reads of the memory map)
+            batch = np.sort(order[start:start + self.batch_size])
+            yield self.get_batch(batch)
+
+    # Slice and normalize a batch of samples (same as ToTensor + Normalize((0.5,), (0.5,)))
+    def get_batch(self, indices):
+        inputs = torch.from_numpy(self.images[indices]).unsqueeze(1).float().div_(127.5).sub_(1.0)
+        targets = torch.from_numpy(self.labels[indices].astype(np.int64))
+
+        return inputs, targets
+
+# Prepare the cache
+if __name__ == '__main__':
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else CACHE_DIR
+    prepare_mnist(cache_dir=cache_dir)
+    TERM.write_success('MNIST cache ready in {}'.format(cache_dir))
@@ -0,0 +1,178 @@
+import time, sys, socket, select
+
+import utils
+from utils import DEBUG_LEVEL, TERM, Communication_Handler
+
+import server
+from server import FLServer
+from client import Client
+import server_trainer
+import shm_transport
+import model_cache
+
+debug_level = DEBUG_LEVEL.INFO
+
+# Intermediate tier: a server to a group of leaf clients and a single client to the root FLServer.
+# Each round it relays the root's weights to its leaves and forwards one (sample weighted) update.
+class EdgeAggregator(FLServer):
+    def __init__(self, host, root, trainer):
+        super(EdgeAggregator, self).__init__(host, trainer)
+
+        # Connection to the root server
+        self.uplink = EdgeUplink(root, self)
+
+        # Use every connected leaf by default
+        self.subset_size = 100000000000
+
+        # Latest model version received from the root
+        self.root_model = model_cache.ModelReceiver()
+
+    # Handles the rounds requested by the root until the root goes away
+    def serve(self):
+        while True:
+            # Wait for weights from the root (reading the leaves' heartbeats meanwhile)
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info('Waiting for model from root...')
+
+            while self.uplink.sock not in self.wait_for_root():
+                pass
+
+            download_start = time.time()
+            weights = Communication_Handler.recv_msg(self.uplink.sock)
+            download_time = time.time() - download_start
+
+            # (the root went away: rejoin it with the same session)
+            if weights is None:
+                if not self.uplink.reconnect():
+                    return
+                continue
+
+            # (ignore cancellations of updates that were already sent)
+            if Communication_Handler.control_msg(weights) is not None:
+                continue
+
+            start = time.time()
+            if not self.load_root_weights(weights):
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('Model could not be loaded: dropping this round.')
+                self.uplink.send(Communication_Handler.cancelled_msg(self.root_model.version))
+                continue
+
+            # Run one round with the leaves
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info('Relaying model to {} leaf client(s)...'.format(len(self.connected_clients_by_addr)))
+
+            self.select_clients(self.subset_size)
+            self.broadcast_model()
+            aggregated_update = self.collect_updates()
+
+            num_samples = sum(self.selected_clients_updates.values())
+            self.aggregated_update = None
+            self.reset_selection()
+
+            # Forward the group's update (or let the root know there is none)
+            if aggregated_update is None or self.uplink.update_cancelled():
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('No update forwarded to root this round.')
+                self.trainer.begin_aggregation()
+                self.uplink.send(Communication_Handler.cancelled_msg(self.root_model.version))
+                continue
+
+            stats = { 'download' : download_time, 'train' : time.time() - start, 'loss' : None }
+            if not self.uplink.send({ 'update' : aggregated_update, 'num_samples' : num_samples, 'stats' : stats, 'version' : self.root_model.version }):
+                if not self.uplink.reconnect():
+                    return
+                continue
+
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_success('Forwarded update of {} samples to root.'.format(num_samples))
+
+    # Wait (up to a heartbeat interval) for the root, handling the leaves' messages meanwhile
+    def wait_for_root(self):
+        with self.client_lock:
+            leaf_socks = list(self.connected_clients_by_sock.keys())
+
+        readable, _, _ = select.select([self.uplink.sock] + leaf_socks, [], [], self.uplink.HEARTBEAT_INTERVAL)
+        for sock in readable:
+            addr = self.connected_clients_by_sock.get(sock)
+            if addr is None:
+                continue
+
+            # (leaves only send heartbeats and stragglers' late replies between rounds)
+            msg, handled = self.recv_from_client(addr, sock)
+            if msg is None:
+                self.remove_client(addr)
+            elif not handled:
+                self.straggling_clients.pop(addr, None)
+
+        self.evict_dead_clients()
+        return readable
+
+    # Make the root's weights this tier's model (what the leaves train on, and the base of their deltas),
+    # returning whether they could be loaded
+    def load_root_weights(self, weights):
+        def load(flat_weights):
+            self.trainer.model.load_state_dict(self.trainer.layout.as_state_dict(flat_weights))
+            return True
+
+        if shm_transport.is_notification(weights):
+            if not shm_transport.read_weights(weights, load):
+                return False
+        elif model_cache.is_model_msg(weights):
+            flat_weights = self.root_model.receive(weights)
+            if flat_weights is None:
+                return False
+            load(flat_weights)
+        else:
+            load(weights)
+
+        # this tier's model version follows the root's (it keys the leaves' diffs and shared memory)
+        self.trainer.round = self.root_model.version if model_cache.is_model_msg(weights) else self.trainer.round + 1
+        return True
+
+# Upstream (client) side of an edge aggregator
+class EdgeUplink(Client):
+    def __init__(self, server, edge):
+        super(EdgeUplink, self).__init__(server, name = 'edge')
+        self.edge = edge
+
+    def run(self):
+        self.edge.serve()
+
+    def cached_version(self):
+        return self.edge.root_model.version
+
+    # Whether the root cancelled the update being computed (without blocking)
+    def update_cancelled(self):
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+
+        return Communication_Handler.control_msg(Communication_Handler.recv_msg(self.sock)) == 'cancel'
+
+### Main Code ###
+
+BUFFER_TIME = 5
+
+if __name__ == '__main__':
+    # the socket for this tier (leaves connect here) and for the root.
+    edge_port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    edge_host = (socket.gethostbyname('localhost'), edge_port)
+    root_host = (socket.gethostbyname('localhost'), 8080)
+
+    # Initialize the edge aggregator (it never evaluates, so no background evaluation).
+    edge = EdgeAggregator(edge_host, root_host, server_trainer.ServerTrainer(async_eval=False))
+
+    # Allow leaf clients to connect
+    edge.start()
+
+    TERM.write_info('Waiting for leaf clients to connect...(Timeout: ' + str(BUFFER_TIME) + 's)')
+    time.sleep(BUFFER_TIME)
+
+    if len(edge.connected_clients_by_addr) == 0:
+        TERM.write_failure("Time limit exceeed: No leaf clients connected.")
+    else:
+        TERM.write_warning('Time limit exceeded: ' + str(len(edge.connected_clients_by_addr)) + ' leaf client(s) connected.')
+
+        # Join the root server and serve its rounds.
+        edge.uplink.connect(BUFFER_TIME)
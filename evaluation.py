@@ -0,0 +1,76 @@
+import torch
+
+from instrumentation import RECORDER
+
+# Correct and total counts per class (one bincount pass each)
+def class_counts(preds, targets, num_classes=10):
+    total_by_class = torch.bincount(targets, minlength=num_classes).float()
+    correct_by_class = torch.bincount(targets[preds == targets], minlength=num_classes).float()
+
+    return correct_by_class, total_by_class
+
+# Per class accuracy (list) and overall accuracy (percent) from class counts
+def class_accuracy(correct_by_class, total_by_class):
+    acc = 100 * correct_by_class.sum() / total_by_class.sum().clamp(min=1.0)
+
+    # TODO: Change classes without samples to be an NaN.
+    total_by_class = total_by_class.clamp(min=1.0)
+
+    return (correct_by_class / total_by_class).cpu().tolist(), float(acc.cpu())
+
+# Accuracy collected from the forward passes of training (no extra pass over the data)
+class RunningAccuracy():
+    def __init__(self, num_classes=10):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.correct_by_class = torch.zeros(self.num_classes)
+        self.total_by_class = torch.zeros(self.num_classes)
+
+    def update(self, outputs, targets):
+        correct, total = class_counts(outputs.detach().argmax(1).cpu(), targets.cpu(), self.num_classes)
+        self.correct_by_class += correct
+        self.total_by_class += total
+
+    def result(self):
+        return class_accuracy(self.correct_by_class, self.total_by_class)
+
+# Evaluates a model on cached tensors, every N rounds and optionally on a fixed random subset
+class Evaluator():
+    def __init__(self, data_loader, every=1, subset=None, batch_size=10000, seed=0, num_classes=10):
+        # Cache the (normalized) data once
+        batches = list(data_loader)
+        self.inputs = torch.cat([inputs for inputs, _ in batches])
+        self.targets = torch.cat([targets for _, targets in batches])
+
+        # Fixed random subset (same samples every time, so results are comparable)
+        if subset is not None and subset < len(self.targets):
+            generator = torch.Generator().manual_seed(seed)
+            indices = torch.randperm(len(self.targets), generator=generator)[:subset]
+            self.inputs = self.inputs[indices]
+            self.targets = self.targets[indices]
+
+        self.every = every
+        self.batch_size = batch_size
+        self.num_classes = num_classes
+
+    # Whether to evaluate at the given (1-based) round / epoch
+    def should_evaluate(self, step):
+        return self.every > 0 and step % self.every == 0
+
+    # Per class accuracy (list) and overall accuracy (percent), optionally in a reduced precision mode
+    def evaluate(self, model, precision=None):
+        device = next(model.parameters()).device
+
+        preds = []
+        with RECORDER.span('compute_accuracy', samples=len(self.targets)), torch.no_grad():
+            for start in range(0, len(self.targets), self.batch_size):
+                inputs = self.inputs[start:start + self.batch_size].to(device)
+                if precision is None:
+                    preds.append(model(inputs).argmax(1).cpu())
+                else:
+                    with precision.autocast(device):
+                        preds.append(model(precision.inputs(inputs)).argmax(1).cpu())
+
+        return class_accuracy(*class_counts(torch.cat(preds), self.targets, self.num_classes))
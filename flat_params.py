@@ -0,0 +1,61 @@
+import collections
+
+import torch
+
+# Maps a model's state dict to a single contiguous 1-D tensor (and back)
+class FlatLayout():
+    def __init__(self, state_dict, dtype=torch.float32):
+        # Flat buffer dtype
+        self.dtype = dtype
+
+        # Cached layout of each entry
+        self.keys = list(state_dict.keys())
+        self.shapes = [tuple(value.shape) for value in state_dict.values()]
+        self.dtypes = [value.dtype for value in state_dict.values()]
+        self.numels = [value.numel() for value in state_dict.values()]
+
+        self.offsets = []
+        offset = 0
+        for numel in self.numels:
+            self.offsets.append(offset)
+            offset += numel
+
+        self.numel = offset
+
+    ### Conversions ###
+
+    # Creates a zero flat buffer
+    def zeros(self, device=None):
+        return torch.zeros(self.numel, dtype=self.dtype, device=device)
+
+    # Copies a state dict into a flat buffer (allocated if not given)
+    def flatten(self, state_dict, out=None):
+        values = [state_dict[key].detach().reshape(-1).to(self.dtype) for key in self.keys]
+
+        if out is None:
+            return torch.cat(values)
+
+        return torch.cat(values, out=out)
+
+    # Creates a state dict of views into a flat buffer (entries of another dtype are copies)
+    def unflatten(self, flat):
+        if flat.numel() != self.numel:
+            raise ValueError('Flat buffer has {} elements, layout expects {}'.format(flat.numel(), self.numel))
+
+        state_dict = collections.OrderedDict()
+        for key, shape, dtype, offset, numel in zip(self.keys, self.shapes, self.dtypes, self.offsets, self.numels):
+            state_dict[key] = flat[offset:offset + numel].view(shape).to(dtype)
+
+        return state_dict
+
+    # Returns the flat form of weights given either as a state dict or a flat buffer
+    def as_flat(self, weights):
+        if torch.is_tensor(weights):
+            return weights
+        return self.flatten(weights)
+
+    # Returns the state dict form of weights given either as a state dict or a flat buffer
+    def as_state_dict(self, weights):
+        if torch.is_tensor(weights):
+            return self.unflatten(weights)
+        return weights
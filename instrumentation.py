@@ -0,0 +1,126 @@
+import os, sys, time, json, threading, collections
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# A timed section of work (its args can be filled in while it runs)
+class Span():
+    __slots__ = ('recorder', 'name', 'args', 'start')
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.record(self.name, self.start, time.time() - self.start, self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+# Stand-in for spans while recording is off
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+NULL_SPAN = NullSpan()
+
+# Records spans and counters in a bounded buffer (cheap enough to leave on), tagged with the current round
+class Recorder():
+    def __init__(self, max_events=100000):
+        self.enabled = True
+        self.process_name = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'python'
+
+        # (kind, name, round, start, duration, thread, args); deque appends are thread safe
+        self.events = collections.deque(maxlen=max_events)
+        self.round = None
+
+    def set_round(self, round_idx):
+        self.round = round_idx
+
+    # Keep (at most) the latest max_events events
+    def set_capacity(self, max_events):
+        self.events = collections.deque(self.events, maxlen=max_events)
+
+    # Time a block: with RECORDER.span('broadcast') as span: ... span.set(bytes_sent=n)
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    # Record a span timed by the caller
+    def record(self, name, start, duration, args=None):
+        if self.enabled:
+            self.events.append(('span', name, self.round, start, duration, threading.get_ident(), args))
+
+    # Record values at this instant (e.g. peak memory)
+    def counter(self, name, **values):
+        if self.enabled:
+            self.events.append(('counter', name, self.round, time.time(), 0.0, threading.get_ident(), values))
+
+    # Record the peak resident memory of this process (and of the GPU, if used)
+    def record_memory(self):
+        if not self.enabled:
+            return
+
+        values = {}
+        if resource is not None:
+            # (kilobytes on Linux, bytes on macOS)
+            scale = 1 if sys.platform == 'darwin' else 1024
+            values['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+            values['peak_cuda'] = torch.cuda.max_memory_allocated()
+
+        self.counter('memory', **values)
+
+    ### Export ###
+
+    # One JSON object per event
+    def export_jsonl(self, file_path):
+        with open(file_path, 'w') as f:
+            for kind, name, round_idx, start, duration, thread, args in list(self.events):
+                f.write(json.dumps(dict(args or {}, kind=kind, name=name, round=round_idx, start=start, duration=duration, thread=thread)) + '\n')
+
+    # Chrome trace event format (chrome://tracing, Perfetto); timestamps are wall clock,
+    # so the traces of a server and its clients on one host line up
+    def export_chrome_trace(self, file_path):
+        pid = os.getpid()
+        trace_events = [{ 'name' : 'process_name', 'ph' : 'M', 'pid' : pid, 'args' : { 'name' : self.process_name } }]
+
+        for kind, name, round_idx, start, duration, thread, args in list(self.events):
+            event = { 'name' : name, 'pid' : pid, 'tid' : thread, 'ts' : start * 1e6, 'args' : dict(args or {}, round=round_idx) }
+            if kind == 'span':
+                event.update(ph='X', dur=duration * 1e6)
+            else:
+                event.update(ph='C', args=args)
+            trace_events.append(event)
+
+        with open(file_path, 'w') as f:
+            json.dump({ 'traceEvents' : trace_events, 'displayTimeUnit' : 'ms' }, f)
+
+    # Write both exports (<prefix>.jsonl and <prefix>.trace.json)
+    def export(self, prefix):
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.export_jsonl(prefix + '.jsonl')
+        self.export_chrome_trace(prefix + '.trace.json')
+
+# Process wide recorder
+RECORDER = Recorder()
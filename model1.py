@@ -23,7 +23,7 @@ class Net(nn.Module):
         x = F.max_pool2d(x, 2, 2)
 
         # Flatten Feature Maps
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         
         # Classification
         x = F.relu(self.fc1(x))
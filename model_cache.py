@@ -0,0 +1,89 @@
+import collections
+
+import update_codec
+
+# Server side of delta broadcasts: an LRU of recent model versions.
+# Each version keeps the weights the clients hold for it and its (quantized) diff from the previous
+# version. The held weights are rebuilt from the quantized diffs exactly as the clients rebuild them,
+# so quantization errors don't accumulate across versions.
+class ModelCache():
+    def __init__(self, size=4, quantize=None):
+        self.size = size
+
+        # Diff encoding: None (float32, exact), 'fp16' or 'int8' (lossy, opt-in)
+        self.quantize = quantize
+
+        # version -> (held flat weights, diff from the previous version or None)
+        self.versions = collections.OrderedDict()
+
+    # Add the flat weights of a (new) version
+    def add(self, version, weights):
+        if version in self.versions:
+            self.versions.move_to_end(version)
+            return
+
+        previous = self.versions.get(version - 1)
+        if previous is None:
+            held, diff = weights.clone(), None
+        else:
+            diff = update_codec.compress(weights - previous[0], self.quantize)
+            diff.update(codec='delta', numel=weights.numel(), indices=None)
+            held = update_codec.decode_delta_into(diff, previous[0].clone())
+
+        self.versions[version] = (held, diff)
+        while len(self.versions) > self.size:
+            self.versions.popitem(last=False)
+
+    # Diffs taking the weights of version base to version (None if a version in between is unknown)
+    def diffs(self, version, base):
+        if base is None or base > version or base not in self.versions:
+            return None
+
+        diffs = []
+        for v in range(base + 1, version + 1):
+            if v not in self.versions or self.versions[v][1] is None:
+                return None
+            diffs.append(self.versions[v][1])
+
+        return diffs
+
+    # Message bringing a client holding version base (None if unknown) to version
+    def message(self, version, base):
+        held, _ = self.versions[version]
+        diffs = self.diffs(version, base)
+
+        # fall back to the full weights when they are no bigger than the diffs
+        if diffs is None or sum(update_codec.payload_nbytes(diff) for diff in diffs) >= update_codec.payload_nbytes(held):
+            return { 'version' : version, 'weights' : held }
+
+        return { 'version' : version, 'base' : base, 'diffs' : diffs }
+
+# Client side of delta broadcasts: the latest version received (what the server diffs against)
+class ModelReceiver():
+    def __init__(self):
+        self.version = None
+        self.weights = None
+
+    # Rebuild the flat weights sent in a model message (and cache them)
+    # (None for a diff against another version than the one held: the held version is then forgotten,
+    # so the server sends the full weights next)
+    def receive(self, msg):
+        if 'diffs' in msg:
+            if msg['base'] != self.version:
+                self.version = None
+                self.weights = None
+                return None
+
+            weights = self.weights.clone()
+            for diff in msg['diffs']:
+                update_codec.decode_delta_into(diff, weights)
+        else:
+            weights = msg['weights']
+
+        self.version = msg['version']
+        self.weights = weights
+        return weights
+
+# Whether a message holds a (versioned) model
+def is_model_msg(msg):
+    return isinstance(msg, dict) and 'version' in msg and ('weights' in msg or 'diffs' in msg)
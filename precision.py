@@ -0,0 +1,67 @@
+import contextlib
+
+import torch
+
+# Opt-in reduced precision execution: autocast (bfloat16 by default, on CPU or CUDA), channels-last
+# activations and optionally a compiled (torch.compile) or TorchScript model. The parameters stay
+# float32: they are the master copies that are trained, sent and aggregated.
+class PrecisionMode():
+    def __init__(self, autocast_dtype=torch.bfloat16, channels_last=False, compile=None):
+        self.autocast_dtype = autocast_dtype
+        self.channels_last = channels_last
+
+        # None, 'compile' (torch.compile) or 'script' (TorchScript)
+        self.compile = compile
+
+    # Prepare a model (in place) and return the module to run it with (sharing its parameters)
+    def prepare(self, model):
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
+
+        if self.compile == 'compile' and hasattr(torch, 'compile'):
+            return torch.compile(model)
+        elif self.compile == 'script':
+            return torch.jit.script(model)
+
+        return model
+
+    # Context running the forward pass in reduced precision
+    def autocast(self, device):
+        if self.autocast_dtype is None or not hasattr(torch, 'autocast'):
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device.type, dtype=self.autocast_dtype)
+
+    # Inputs in the memory format the model runs in
+    def inputs(self, inputs):
+        if self.channels_last and inputs.dim() == 4:
+            return inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    def __str__(self):
+        parts = [str(self.autocast_dtype).replace('torch.', '') if self.autocast_dtype is not None else 'fp32']
+        if self.channels_last:
+            parts.append('channels_last')
+        if self.compile is not None:
+            parts.append(self.compile)
+        return '+'.join(parts)
+
+# Build a precision mode from a spec such as 'bf16', 'bf16+channels_last' or 'fp16+channels_last+compile'
+# ('fp32' or None runs everything in float32 as before)
+def make_precision(spec):
+    if spec is None or spec == 'fp32':
+        return None
+
+    precision = PrecisionMode(autocast_dtype=None)
+    for part in spec.split('+'):
+        if part == 'bf16':
+            precision.autocast_dtype = torch.bfloat16
+        elif part == 'fp16':
+            precision.autocast_dtype = torch.float16
+        elif part == 'channels_last':
+            precision.channels_last = True
+        elif part in ('compile', 'script'):
+            precision.compile = part
+        elif part != 'fp32':
+            raise ValueError('Unknown precision \'{}\''.format(part))
+
+    return precision
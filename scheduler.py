@@ -0,0 +1,167 @@
+import time, json, random, collections
+
+# Measured history of a single client
+class ClientStats():
+    def __init__(self, history=10):
+        self.download_times = collections.deque(maxlen=history)
+        self.train_times = collections.deque(maxlen=history)
+        self.upload_times = collections.deque(maxlen=history)
+        self.latencies = collections.deque(maxlen=history)
+
+        self.loss = None
+        self.rounds = 0
+
+        # Outstanding dispatch (time sent, predicted latency)
+        self.dispatch_time = None
+        self.predicted_latency = None
+
+    # Expected round trip (download + train + upload), None if never measured
+    def expected_latency(self):
+        if len(self.latencies) == 0:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+# Base client selection scheduler: keeps per-client stats and a log of its decisions
+class ClientScheduler():
+    def __init__(self):
+        self.stats = collections.defaultdict(ClientStats)
+
+        # One entry per selection: round, selected clients and their predicted latency
+        self.decisions = []
+
+        # One entry per reply: client, predicted and actual latency
+        self.outcomes = []
+
+    ### Selection ###
+
+    # Pick num_clients of the candidate clients
+    def select(self, candidates, num_clients, round_idx):
+        selected = self.choose(list(candidates), num_clients)
+
+        self.decisions.append({ 'round' : round_idx, 'time' : time.time(), 'selected' : [str(addr) for addr in selected],
+                                'predicted' : [self.stats[addr].expected_latency() for addr in selected] })
+        return selected
+
+    def choose(self, candidates, num_clients):
+        raise NotImplementedError
+
+    ### Measurements ###
+
+    # The model was sent to the given clients
+    def record_dispatch(self, client_addrs, dispatch_time=None):
+        dispatch_time = time.time() if dispatch_time is None else dispatch_time
+        for addr in client_addrs:
+            stats = self.stats[addr]
+            stats.dispatch_time = dispatch_time
+            stats.predicted_latency = stats.expected_latency()
+
+    # A client replied, reporting its download / train times and its training loss
+    def record_result(self, addr, reply_time=None, client_stats=None):
+        stats = self.stats[addr]
+        if stats.dispatch_time is None:
+            return
+
+        reply_time = time.time() if reply_time is None else reply_time
+        latency = reply_time - stats.dispatch_time
+        client_stats = {} if client_stats is None else client_stats
+
+        download = client_stats.get('download', 0.0)
+        train = client_stats.get('train', 0.0)
+
+        stats.latencies.append(latency)
+        stats.download_times.append(download)
+        stats.train_times.append(train)
+        stats.upload_times.append(max(0.0, latency - download - train))
+        stats.rounds += 1
+        if client_stats.get('loss') is not None:
+            stats.loss = client_stats['loss']
+
+        self.outcomes.append({ 'client' : str(addr), 'time' : reply_time, 'predicted' : stats.predicted_latency, 'actual' : latency,
+                               'download' : download, 'train' : train, 'upload' : stats.upload_times[-1] })
+        stats.dispatch_time = None
+
+    # Forget a client (e.g. once it disconnects)
+    def remove_client(self, addr):
+        self.stats.pop(addr, None)
+
+    # Write the selection decisions and outcomes as JSON lines
+    def export(self, file_path):
+        with open(file_path, 'w') as f:
+            for decision in self.decisions:
+                f.write(json.dumps(dict(decision, kind='decision')) + '\n')
+            for outcome in self.outcomes:
+                f.write(json.dumps(dict(outcome, kind='outcome')) + '\n')
+
+# Uniformly random selection
+class UniformScheduler(ClientScheduler):
+    def choose(self, candidates, num_clients):
+        return random.sample(candidates, min(num_clients, len(candidates)))
+
+# Cycles through the clients in a fixed order
+class RoundRobinScheduler(ClientScheduler):
+    def __init__(self):
+        super(RoundRobinScheduler, self).__init__()
+        self.position = 0
+
+    def choose(self, candidates, num_clients):
+        candidates = sorted(candidates, key=str)
+        if len(candidates) == 0:
+            return []
+
+        start = self.position % len(candidates)
+        ordered = candidates[start:] + candidates[:start]
+        self.position = start + num_clients
+
+        return ordered[:num_clients]
+
+# Prefers clients expected to reply within the deadline (unmeasured clients are explored first)
+class ThroughputScheduler(ClientScheduler):
+    def __init__(self, deadline=None, slack=1.0):
+        super(ThroughputScheduler, self).__init__()
+
+        # Round deadline (seconds) and how much of it a client's expected latency may use
+        self.deadline = deadline
+        self.slack = slack
+
+    def choose(self, candidates, num_clients):
+        unmeasured = [addr for addr in candidates if self.stats[addr].expected_latency() is None]
+        measured = sorted([addr for addr in candidates if self.stats[addr].expected_latency() is not None], key=lambda addr: self.stats[addr].expected_latency())
+
+        if self.deadline is not None:
+            feasible = [addr for addr in measured if self.stats[addr].expected_latency() <= self.slack * self.deadline]
+            infeasible = [addr for addr in measured if addr not in feasible]
+        else:
+            feasible, infeasible = measured, []
+
+        # explore new clients, then a random mix of those expected in time, then the fastest of the rest
+        random.shuffle(unmeasured)
+        random.shuffle(feasible)
+        return (unmeasured + feasible + infeasible)[:num_clients]
+
+# Power-of-choice: sample d candidates, keep the ones with the highest (last reported) loss
+class PowerOfChoiceScheduler(ClientScheduler):
+    def __init__(self, d=None):
+        super(PowerOfChoiceScheduler, self).__init__()
+
+        # Candidate set size (None uses twice the number of clients selected)
+        self.d = d
+
+    def choose(self, candidates, num_clients):
+        d = 2 * num_clients if self.d is None else self.d
+        sampled = random.sample(candidates, min(max(d, num_clients), len(candidates)))
+
+        # clients that never reported a loss come first
+        return sorted(sampled, key=lambda addr: -float('inf') if self.stats[addr].loss is None else -self.stats[addr].loss)[:num_clients]
+
+# Build a scheduler by name ('uniform', 'round_robin', 'throughput', 'power_of_choice')
+def make_scheduler(name, deadline=None):
+    if name == 'uniform':
+        return UniformScheduler()
+    elif name == 'round_robin':
+        return RoundRobinScheduler()
+    elif name == 'throughput':
+        return ThroughputScheduler(deadline)
+    elif name == 'power_of_choice':
+        return PowerOfChoiceScheduler()
+
+    raise ValueError('Unknown scheduler \'{}\''.format(name))
@@ -0,0 +1,342 @@
+import hashlib, secrets
+
+import numpy as np
+import torch
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+from instrumentation import RECORDER
+
+debug_level = DEBUG_LEVEL.INFO
+
+# Secure aggregation with pairwise masks (Bonawitz et al.): each client adds masks that cancel in the sum of
+# its group, so the server only learns the (sample weighted) sum of the updates. The group members agree on
+# the masks' seeds with Diffie-Hellman keys exchanged through the server, so there is no trusted third party.
+#
+# Within a group of G clients, client i sends y_i = encode(x_i) + PRG(b_i) + sum_{j>i} PRG(s_ij) - sum_{j<i} PRG(s_ij)
+#  - s_ij is a per-round seed derived from the key agreed by i and j (agreed once, reused every round),
+#  - b_i is a fresh self mask seed, Shamir shared among the group (the shares travel with y_i, encrypted for each member).
+# Once the updates are in, the server asks the members that sent theirs (the survivors) for the shares of the
+# survivors' self masks and for their seeds with the members that dropped out, and removes both from the sum.
+# No member reveals both for the same client, so a late update stays masked by its b_i.
+#
+# Masks are only agreed within a group, so each client does G key agreements and mask expansions (not one per
+# client in the round); the server can learn the sum of any group, so G is the size of the crowd each update hides in.
+# The server is trusted to follow the protocol (honest but curious), as the clients are.
+
+# RFC 3526 2048-bit MODP group (generator 2)
+DH_PRIME = int(
+    'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DD'
+    'EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+    'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F'
+    '83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+    'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
+    '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+DH_GENERATOR = 2
+
+# Shamir shares live in the field of this (Mersenne) prime, so a share fits in 16 bytes
+SHAMIR_PRIME = 2**127 - 1
+
+# Fixed point scale of the encoded updates: the sum is exact modulo 2^64, and stays below 2^63 while
+# sum(num_samples * |weight|) < 2^39 (e.g. a million samples of weights up to 5e5)
+FIXED_POINT_SCALE = 2**24
+
+### Key agreement ###
+
+def generate_keypair():
+    private_key = secrets.randbits(256) | (1 << 255)
+    return private_key, pow(DH_GENERATOR, private_key, DH_PRIME)
+
+def agree(private_key, peer_public_key):
+    if not 1 < peer_public_key < DH_PRIME - 1:
+        raise ValueError('Invalid public key')
+    return hashlib.sha256(pow(peer_public_key, private_key, DH_PRIME).to_bytes(256, 'big')).digest()
+
+# Seed of a pair's mask in a round (revealing it says nothing about the pair's other rounds)
+def round_seed(secret, round_idx):
+    return int.from_bytes(hashlib.sha256(b'mask' + secret + round_idx.to_bytes(8, 'big')).digest()[:16], 'big')
+
+# One time pad of the share sender gives receiver in a round
+def share_pad(secret, round_idx, sender, receiver):
+    digest = hashlib.sha256(b'share' + secret + round_idx.to_bytes(8, 'big') + sender.encode() + b'/' + receiver.encode()).digest()
+    return int.from_bytes(digest[:16], 'big')
+
+### Masks ###
+
+# Pseudorandom int64 vector of a seed (PCG64's raw output, generated in one vectorized call)
+def prg(seed, length):
+    return np.random.PCG64(seed).random_raw(length).view(np.int64)
+
+# Fixed point encoding of an update weighted by its sample count, followed by the sample count
+# (every element is masked, so the server only learns the total weight too)
+def encode(flat_weights, num_samples):
+    flat_weights = np.array(flat_weights.detach().cpu().numpy(), dtype=np.float64)
+
+    encoded = np.empty(flat_weights.shape[0] + 1, dtype=np.int64)
+    np.rint(flat_weights * (num_samples * FIXED_POINT_SCALE), out=flat_weights)
+    encoded[:-1] = flat_weights
+    encoded[-1] = num_samples
+    return encoded
+
+# Weighted average of a decoded sum (None if it has no weight)
+def decode(total):
+    weight = int(total[-1])
+    if weight <= 0:
+        return None
+    return torch.from_numpy((total[:-1].astype(np.float64) / (weight * FIXED_POINT_SCALE)).astype(np.float32))
+
+### Shamir secret sharing ###
+
+# Shares needed to rebuild a self mask: a majority of the group (and at least 2, so no single member can)
+def threshold(group_size):
+    return max(2, group_size // 2 + 1)
+
+# Shares of a secret for members 1..count, any num_needed of which rebuild it
+def split(secret, count, num_needed):
+    coefficients = [secret] + [secrets.randbelow(SHAMIR_PRIME) for _ in range(num_needed - 1)]
+
+    shares = []
+    for x in range(1, count + 1):
+        y = 0
+        for coefficient in reversed(coefficients):
+            y = (y * x + coefficient) % SHAMIR_PRIME
+        shares.append(y)
+    return shares
+
+# Rebuild a secret from (x, share) pairs (Lagrange interpolation at 0)
+def combine(shares):
+    secret = 0
+    for k, (x_k, y_k) in enumerate(shares):
+        numerator, denominator = 1, 1
+        for m, (x_m, _) in enumerate(shares):
+            if m != k:
+                numerator = numerator * x_m % SHAMIR_PRIME
+                denominator = denominator * (x_m - x_k) % SHAMIR_PRIME
+        secret = (secret + y_k * numerator * pow(denominator, SHAMIR_PRIME - 2, SHAMIR_PRIME)) % SHAMIR_PRIME
+    return secret
+
+### Client ###
+
+# A client's side of the protocol (its keys outlive connections, like its session)
+class SecureAggregationClient():
+    def __init__(self, member_id):
+        self.member_id = member_id
+        self.private_key, self.public_key = generate_keypair()
+
+        # Keys agreed with peers (by peer and public key), reused every round
+        self.secrets = {}
+
+        # Current round: its id, members [(member id, public key)] and this client's position
+        self.round = -1
+        self.members = None
+        self.position = None
+
+        # Last rounds this client masked an update for and revealed its secrets for (each only once per round)
+        self.masked_round = -1
+        self.revealed_round = -1
+
+    def secret(self, peer, public_key):
+        key = (peer, public_key)
+        if key not in self.secrets:
+            self.secrets[key] = agree(self.private_key, public_key)
+        return self.secrets[key]
+
+    # Handle a protocol message from the server (returns the reply to send, if any)
+    def handle(self, msg):
+        control = msg.get('control')
+        if control == 'secagg_group':
+            self.set_group(msg)
+        elif control == 'secagg_unmask':
+            return self.reveal(msg)
+        return None
+
+    # Join the group of a new round (round ids only increase, so seeds are never reused)
+    def set_group(self, msg):
+        member_ids = [member for member, _ in msg['members']]
+        if msg['round'] <= self.round or self.member_id not in member_ids:
+            if debug_level >= DEBUG_LEVEL.WARNS:
+                TERM.write_warning('Ignoring secure aggregation group of round {}.'.format(msg['round']))
+            return
+
+        self.round = msg['round']
+        self.members = msg['members']
+        self.position = member_ids.index(self.member_id)
+
+        # agree on the pairwise secrets now (while waiting for the model), not while masking
+        with RECORDER.span('secure_key_agreement', peers=len(self.members) - 1):
+            for peer, public_key in self.members:
+                self.secret(peer, public_key)
+
+    # Mask an update (full flat weights) for this round's group
+    def mask(self, flat_weights, num_samples):
+        if self.members is None or self.masked_round == self.round:
+            return None
+        self.masked_round = self.round
+
+        with RECORDER.span('secure_mask', peers=len(self.members) - 1) as span:
+            masked = encode(flat_weights, num_samples)
+
+            # self mask
+            self_seed = secrets.randbelow(SHAMIR_PRIME)
+            np.add(masked, prg(self_seed, masked.shape[0]), out=masked)
+
+            # pairwise masks (cancelling in the group's sum; int64 arithmetic wraps around)
+            for position, (peer, public_key) in enumerate(self.members):
+                if position == self.position:
+                    continue
+                mask = prg(round_seed(self.secret(peer, public_key), self.round), masked.shape[0])
+                if self.position < position:
+                    np.add(masked, mask, out=masked)
+                else:
+                    np.subtract(masked, mask, out=masked)
+
+            # shares of the self mask, each encrypted for its member
+            shares = split(self_seed, len(self.members), threshold(len(self.members)))
+            encrypted = { peer : share ^ share_pad(self.secret(peer, public_key), self.round, self.member_id, peer) for share, (peer, public_key) in zip(shares, self.members) }
+
+            span.set(numel=masked.shape[0])
+
+        return { 'masked' : torch.from_numpy(masked), 'shares' : encrypted, 'round' : self.round }
+
+    # Reveal the survivors' self mask shares and the seeds shared with the members that dropped out
+    def reveal(self, msg):
+        round_idx, survivors, dropped = msg['round'], msg['survivors'], msg['dropped']
+
+        public_keys = dict(self.members or [])
+        valid = (round_idx == self.masked_round and round_idx > self.revealed_round and self.member_id in survivors
+                 and sorted(survivors + dropped) == sorted(public_keys.keys()) and len(survivors) >= threshold(len(public_keys)))
+        if not valid:
+            if debug_level >= DEBUG_LEVEL.WARNS:
+                TERM.write_warning('Refusing to unmask round {}.'.format(round_idx))
+            return None
+
+        self.revealed_round = round_idx
+
+        shares = { sender : encrypted ^ share_pad(self.secret(sender, public_keys[sender]), round_idx, sender, self.member_id)
+                   for sender, encrypted in msg['shares'].items() if sender in survivors }
+        seeds = { peer : round_seed(self.secret(peer, public_keys[peer]), round_idx) for peer in dropped }
+
+        return { 'control' : 'secagg_reveal', 'round' : round_idx, 'shares' : shares, 'seeds' : seeds }
+
+### Server ###
+
+# The server's side of a round: the masked sums of the groups, unmasked once the survivors reveal their secrets
+class SecureAggregator():
+    def __init__(self, round_idx, groups, length):
+        self.round = round_idx
+        self.groups = groups
+        self.length = length
+
+        # member -> (group, position)
+        self.positions = { member : (g, position) for g, group in enumerate(groups) for position, member in enumerate(group) }
+
+        # per group: the masked sum, the shares each survivor sent (encrypted, by receiver) and each survivor's reveal
+        self.sums = [None] * len(groups)
+        self.received = [{} for _ in groups]
+        self.revealed = [{} for _ in groups]
+
+    # Add a member's masked update to its group's sum, returning whether it was accepted
+    def add(self, member, update):
+        if member not in self.positions or update.get('round') != self.round:
+            return False
+
+        g, _ = self.positions[member]
+        if member in self.received[g]:
+            return False
+
+        masked = update['masked'].numpy()
+        if self.sums[g] is None:
+            self.sums[g] = masked.copy()
+        else:
+            np.add(self.sums[g], masked, out=self.sums[g])
+
+        self.received[g][member] = update['shares']
+        return True
+
+    def survivors(self, g):
+        return [member for member in self.groups[g] if member in self.received[g]]
+
+    def dropped(self, g):
+        return [member for member in self.groups[g] if member not in self.received[g]]
+
+    # Unmask request of each survivor (groups too small to unmask are skipped)
+    def unmask_requests(self):
+        requests = {}
+        for g, group in enumerate(self.groups):
+            survivors, dropped = self.survivors(g), self.dropped(g)
+            if len(survivors) < threshold(len(group)):
+                continue
+
+            for member in survivors:
+                shares = { sender : self.received[g][sender][member] for sender in survivors }
+                requests[member] = { 'control' : 'secagg_unmask', 'round' : self.round, 'survivors' : survivors, 'dropped' : dropped, 'shares' : shares }
+
+        return requests
+
+    def reveal(self, member, msg):
+        if member in self.positions and msg.get('round') == self.round:
+            g, _ = self.positions[member]
+            self.revealed[g][member] = msg
+
+    # Average of the unmasked groups (None if none could be unmasked)
+    def finalize(self):
+        total = None
+        unmasked, num_groups = 0, 0
+
+        for g, group in enumerate(self.groups):
+            if self.sums[g] is None:
+                continue
+            num_groups += 1
+
+            group_sum = self.unmask(g)
+            if group_sum is None:
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('Secure aggregation: group {} ({} members, {} updates) could not be unmasked: leaving it out.'.format(g, len(group), len(self.received[g])))
+                continue
+
+            unmasked += 1
+            if total is None:
+                total = group_sum
+            else:
+                np.add(total, group_sum, out=total)
+
+        if debug_level >= DEBUG_LEVEL.ALL:
+            TERM.write('\tUnmasked {}/{} groups'.format(unmasked, num_groups))
+
+        return None if total is None else decode(total)
+
+    # Remove the masks left in a group's sum (None if its survivors did not reveal enough)
+    def unmask(self, g):
+        group, group_sum = self.groups[g], self.sums[g]
+        survivors, dropped = self.survivors(g), self.dropped(g)
+        responders = [member for member in survivors if member in self.revealed[g]
+                      and set(survivors) <= set(self.revealed[g][member]['shares']) and set(dropped) <= set(self.revealed[g][member]['seeds'])]
+
+        # the self masks need a threshold of shares; the masks with dropped members need every survivor's seeds.
+        if len(responders) < threshold(len(group)) or (dropped and len(responders) < len(survivors)):
+            return None
+
+        num_needed = threshold(len(group))
+        for member in survivors:
+            shares = [(self.positions[responder][1] + 1, self.revealed[g][responder]['shares'][member]) for responder in responders[:num_needed]]
+            np.subtract(group_sum, prg(combine(shares), self.length), out=group_sum)
+
+        for member in survivors:
+            position = self.positions[member][1]
+            for peer in dropped:
+                mask = prg(self.revealed[g][member]['seeds'][peer], self.length)
+                # (the survivor added the mask if it came first)
+                if position < self.positions[peer][1]:
+                    np.subtract(group_sum, mask, out=group_sum)
+                else:
+                    np.add(group_sum, mask, out=group_sum)
+
+        return group_sum
+
+# Split a round's members into groups of group_size (a last group too small to hide its members joins the previous one)
+def make_groups(members, group_size):
+    groups = [members[i:i + group_size] for i in range(0, len(members), group_size)]
+    if len(groups) > 1 and len(groups[-1]) < threshold(group_size):
+        last = groups.pop()
+        groups[-1] = groups[-1] + last
+    return groups
@@ -1,51 +1,81 @@
-import time, sys, threading, errno, socket, queue, pickle, random, select
+import time, sys, threading, errno, socket, queue, pickle, random, select, math
 from random import sample
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
 from utils import DEBUG_LEVEL, TERM, Communication_Handler
+from instrumentation import RECORDER
 
 import server_trainer
+import shm_transport
+import scheduler
+import checkpoint
+import model_cache
+import precision
+import secure_aggregation
+import server_optimizer
 
 debug_level = DEBUG_LEVEL.INFO
 
 class Server():
     def __init__(self, host):
-        if debug_level >= DEBUG_LEVEL.INFO:
-            TERM.write_info('Started server at ' + str(host))
+        # the socket to listen for connections on (None when clients are not remote).
+        self.listener_sock = None
+
+        if host is not None:
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info('Started server at ' + str(host))
 
-        # the socket to listen for connections on.
-        self.listener_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listener_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.listener_sock.bind(host)
+            self.listener_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener_sock.bind(host)
 
         self.listener_process = None
         self.listening = False
 
         self.client_lock = threading.Lock()
 
-        # the set of connected clients.
+        # workers used to write broadcasts to many sockets at once.
+        self.MAX_SEND_WORKERS = 32
+        self.send_pool = ThreadPoolExecutor(max_workers = self.MAX_SEND_WORKERS)
+
+        # per-client (latency in seconds, bytes sent) of the last broadcast.
+        self.broadcast_stats = {}
+
+        # the set of connected clients (and when each was last heard from).
         self.connected_clients_by_sock = {}
         self.connected_clients_by_addr = {}
+        self.last_seen = {}
+
+        # TODO: make number variable
+        self.BACKLOG = 128
 
     # Connects to the clients (and caches them).
     def listen_for_clients(self):
-        # TODO: make number bigger/variable
-        self.listener_sock.listen(5)
+        self.listener_sock.listen(self.BACKLOG)
 
         while self.listening:
             # Accept connection.
             client_sock, client_addr = self.listener_sock.accept()
+            client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
             if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write_success('Established connection to {}'.format(client_addr))
 
             # cache the client socket.
-            self.connected_clients_by_addr[client_addr] = client_sock
-            self.connected_clients_by_sock[client_sock] = client_addr
+            with self.client_lock:
+                self.connected_clients_by_addr[client_addr] = client_sock
+                self.connected_clients_by_sock[client_sock] = client_addr
+                self.last_seen[client_addr] = time.time()
 
     # Starts listener thread to add connected clients.
     def start(self):
         self.listening = True
+
+        # nothing to listen on / already listening.
+        if self.listener_sock is None or (self.listener_process is not None and self.listener_process.is_alive()):
+            return
+
         self.listener_process = threading.Thread(target = self.listen_for_clients, daemon = True)
         self.listener_process.start()
 
@@ -56,17 +86,40 @@ class Server():
     # Removes the specified client if it exists.
     def remove_client(self, addr):
         with self.client_lock:
-            sock = self.connected_clients_by_addr.pop(addr)
-            self.connected_clients_by_sock.pop(sock)
+            sock = self.connected_clients_by_addr.pop(addr, None)
+            self.connected_clients_by_sock.pop(sock, None)
+            self.last_seen.pop(addr, None)
 
             if sock:
                 sock.close()
 
     # Broadcasts a message to a subset of the clients
     def broadcast(self, client_addrs, msg):
+        start = time.time()
+
+        # serialize once; every send shares the same read-only buffers.
+        buffers = Communication_Handler.pack_msg(msg)
+        msg_len = Communication_Handler.frame_size(buffers)
+
         with self.client_lock:
-            for client_addr in client_addrs:
-                Communication_Handler.send_msg(self.connected_clients_by_addr[client_addr], msg)
+            client_socks = { addr : self.connected_clients_by_addr[addr] for addr in client_addrs if addr in self.connected_clients_by_addr }
+
+        def send(sock):
+            start = time.time()
+            sent = Communication_Handler.send_frame(sock, buffers)
+            return time.time() - start, msg_len if sent else 0
+
+        # write to all the sockets concurrently.
+        futures = { addr : self.send_pool.submit(send, sock) for addr, sock in client_socks.items() }
+        self.broadcast_stats = { addr : future.result() for addr, future in futures.items() }
+
+        if debug_level >= DEBUG_LEVEL.ALL:
+            for addr, (latency, nbytes) in self.broadcast_stats.items():
+                TERM.write('\tSent {} bytes to {} in {:0.3f}s'.format(nbytes, addr, latency))
+
+        RECORDER.record('broadcast', start, time.time() - start, { 'clients' : len(client_socks), 'bytes_sent' : sum(nbytes for _, nbytes in self.broadcast_stats.values()) })
+
+        return self.broadcast_stats
 
 class FLServer(Server):
 
@@ -77,6 +130,7 @@ class FLServer(Server):
         self.selected_clients_by_addr = {}
         self.selected_clients_by_sock = {}
 
+        # sample counts of the clients whose update has been folded into the running aggregate.
         self.selected_clients_updates = {}
 
         # Flags / Cache for FL loop
@@ -87,12 +141,61 @@ class FLServer(Server):
         self.trainer = trainer
         self.subset_size = 3 # Default
 
-        # Timeout.
+        # Timeout (round deadline, in seconds).
         self.TIMEOUT = 100000000000
 
+        # Over-selection: select over_selection * subset_size clients, aggregate the first subset_size
+        # updates, and (at the deadline) aggregate whatever arrived if at least min_updates did.
+        self.over_selection = 1.0
+        self.min_updates = 1
+        self.round_target = 0
+
+        # Clients whose update was not used (cancelled), and that are still busy with it.
+        self.straggling_clients = {}
+
+        # Client selection policy (keeps each client's measured latency and loss).
+        self.scheduler = scheduler.UniformScheduler()
+
+        # Sessions (kept by clients across reconnects) and the timeout after which a silent client is evicted.
+        self.sessions = {}
+        self.session_by_addr = {}
+        self.HEARTBEAT_TIMEOUT = 30
+
+        # Publish the weights through shared memory (clients on this host) instead of sending them
+        # (keeping the latest shm_retain versions mapped).
+        self.shared_memory = False
+        self.shm_retain = 2
+        self.publisher = None
+        self.published_round = None
+        self.published_weights = None
+
+        # Asynchronous (buffered) training: updates per aggregate (None uses subset_size), server learning rate,
+        # the staleness beyond which updates are dropped, and the model version each busy client is training on.
+        self.buffer_size = None
+        self.server_lr = 1.0
+        self.max_staleness = 8
+        self.model_version = 0
+        self.dispatched_versions = {}
+        self.version_weights = {}
+
+        # Number of rounds to train for (None trains until all clients disconnect).
+        self.num_rounds = None
+        self.rounds_completed = 0
+
+        # Versioned checkpoints of the global model (None keeps it only in memory).
+        self.checkpoints = None
+
+        # Recent model versions (clients holding one get a diff instead of the full weights; None always sends them)
+        # and the version each client reported it holds.
+        self.model_cache = model_cache.ModelCache()
+        self.client_versions = {}
+
     # Executes FL Training Loop
     def train(self):
-        while len(self.connected_clients_by_addr) > 0:
+        while len(self.connected_clients_by_addr) > 0 and (self.num_rounds is None or self.rounds_completed < self.num_rounds):
+            round_start = time.time()
+            RECORDER.set_round(self.trainer.round)
+
             # select a subset of the clients and broadcast the model.
             if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write_info("Selecting clients...")
@@ -107,12 +210,8 @@ class FLServer(Server):
             if debug_level >= DEBUG_LEVEL.INFO:
                 TERM.write_info("Waiting for updates...(Timeout: " + str(self.TIMEOUT) + ")")
 
-            start = time.time()
-
-            # wait for each client's update and then aggregate.
-            while (self.aggregated_update is None) and time.time() - start < self.TIMEOUT:
-                self.wait_for_updates()
-                self.attempt_to_aggregate_updates()
+            # wait for the clients' updates (until the deadline) and then aggregate.
+            self.collect_updates()
 
             # if an aggregated update has been created...
             if self.aggregated_update is not None:
@@ -120,16 +219,13 @@ class FLServer(Server):
                 self.stop()
 
                 if debug_level >= DEBUG_LEVEL.INFO:
-                    TERM.write_success("All updates received.")
+                    TERM.write_success("Updates received.")
                     TERM.write_info("Aggregating updates...")
 
                 # Update the model using aggregated update.
                 self.update_model(self.aggregated_update)
                 self.aggregated_update = None
-
-                # reset the selected client address list (to be re-selected)
-                self.selected_clients_by_addr = {}
-                self.selected_clients_updates = {}
+                self.rounds_completed += 1
 
                 if debug_level >= DEBUG_LEVEL.INFO:
                     TERM.write_info("Sending aggregated update to clients...")
@@ -138,50 +234,531 @@ class FLServer(Server):
                 self.start()
             else:
                 if debug_level >= DEBUG_LEVEL.INFO:
-                    TERM.write_warning("Time-limit exceeded: Some updates were not received.")
+                    TERM.write_warning("Round skipped: Not enough updates were received.")
 
-        if debug_level >= DEBUG_LEVEL.INFO:
+                self.trainer.begin_aggregation()
+
+                # (nobody could be selected: keep serving heartbeats and connections until a client is free)
+                if len(self.selected_clients_by_addr) == 0:
+                    self.wait_for_updates(1.0)
+
+            RECORDER.record('round', round_start, time.time() - round_start, { 'selected' : len(self.selected_clients_by_addr), 'updates' : len(self.selected_clients_updates) })
+            RECORDER.record_memory()
+
+            # reset the selected client address list (to be re-selected)
+            self.reset_selection()
+
+        # let the last round's (background) evaluation finish.
+        self.trainer.wait_for_evaluations()
+
+        if len(self.connected_clients_by_addr) == 0 and debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_failure("All clients disconected.")
+
+    # Wait (until the round deadline) for the selected clients' updates and aggregate them
+    def collect_updates(self):
+        deadline = time.time() + self.TIMEOUT
+        finalized = False
+
+        while not finalized and time.time() < deadline:
+            # every selected client has replied or dropped out (e.g. none was selected): no more updates are coming.
+            if len(self.selected_clients_updates) >= len(self.selected_clients_by_addr):
+                break
+
+            self.wait_for_updates(deadline - time.time())
+            finalized = self.attempt_to_aggregate_updates()
+
+        # deadline reached: aggregate the updates that did arrive.
+        if not finalized and len(self.selected_clients_updates) >= max(1, self.min_updates):
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_warning("Time-limit exceeded: aggregating {}/{} updates.".format(len(self.selected_clients_updates), self.round_target))
+
+            self.aggregated_update = self.finalize_updates()
+
+        # cancel the clients whose updates will not be used.
+        self.cancel_pending_clients()
+
+        return self.aggregated_update
+
+    # Forget the current round's selection (to be re-selected)
+    def reset_selection(self):
+        self.selected_clients_by_addr = {}
+        self.selected_clients_by_sock = {}
+        self.selected_clients_updates = {}
+
+    # Executes asynchronous (FedBuff-style) training: every idle client trains on the latest model,
+    # and an aggregate is applied each time buffer_size updates have arrived.
+    def train_async(self):
+        buffer_size = self.subset_size if self.buffer_size is None else self.buffer_size
+        num_buffered = 0
+
+        self.trainer.begin_aggregation()
+        self.version_weights = { self.model_version : self.trainer.flat_state() }
+
+        # every version a client may still be training on stays published.
+        self.shm_retain = max(self.shm_retain, self.max_staleness + 1)
+
+        while len(self.connected_clients_by_addr) > 0 and (self.num_rounds is None or self.rounds_completed < self.num_rounds):
+            # keep every connected client busy.
+            self.dispatch_model([addr for addr in list(self.connected_clients_by_addr.keys()) if addr not in self.dispatched_versions])
+
+            with self.client_lock:
+                busy_socks = [self.connected_clients_by_addr[addr] for addr in self.dispatched_versions if addr in self.connected_clients_by_addr]
+
+            readable_clients_socks, _, _ = select.select(busy_socks, [], [], 1.0)
+            for sock in readable_clients_socks:
+                addr = self.connected_clients_by_sock.get(sock)
+                if addr is None:
+                    continue
+
+                msg, handled = self.recv_from_client(addr, sock)
+
+                if msg is None:
+                    if debug_level >= DEBUG_LEVEL.WARNS:
+                        TERM.write_warning('No update from {}: removing it.'.format(addr))
+                    self.remove_client(addr)
+                    continue
+
+                if handled:
+                    continue
+
+                version = self.dispatched_versions.pop(addr)
+
+                # no update this time (e.g. an edge aggregator whose leaves all missed their deadline).
+                if Communication_Handler.control_msg(msg) is not None:
+                    self.dispatch_model([addr])
+                    continue
+
+                self.scheduler.record_result(self.client_identity(addr), time.time(), msg.get('stats') if isinstance(msg, dict) else None)
+
+                # drop updates that are too stale (their model may not be published anymore).
+                staleness = self.model_version - version
+                if staleness > self.max_staleness:
+                    if debug_level >= DEBUG_LEVEL.WARNS:
+                        TERM.write_warning('Update from {} is {} versions stale: dropping it.'.format(addr, staleness))
+                    self.dispatch_model([addr])
+                    continue
+
+                # weigh the update's delta by its sample count and discount it by its staleness
+                # (the average is over the sample counts only, so the discount shrinks the step instead of cancelling out).
+                update, num_samples = Communication_Handler.unpack_update(msg)
+                self.trainer.accumulate(self.trainer.delta_update(update, self.base_weights(version)), num_samples * self.staleness_weight(staleness), num_samples)
+                num_buffered += 1
+
+                if debug_level >= DEBUG_LEVEL.ALL:
+                    TERM.write('\tUpdate from {} (staleness {})'.format(addr, staleness))
+
+                if num_buffered >= buffer_size:
+                    if debug_level >= DEBUG_LEVEL.INFO:
+                        TERM.write_info("Applying {} buffered updates...".format(num_buffered))
+
+                    self.apply_buffered_updates()
+                    num_buffered = 0
+
+                # re-dispatch straight away (with the latest model).
+                self.dispatch_model([addr])
+
+            self.evict_dead_clients()
+
+            # forget versions no client is training on anymore.
+            in_use = set(self.dispatched_versions.values())
+            for version in list(self.version_weights.keys()):
+                if version != self.model_version and version not in in_use:
+                    del self.version_weights[version]
+
+        # let the last round's (background) evaluation finish.
+        self.trainer.wait_for_evaluations()
+
+        if len(self.connected_clients_by_addr) == 0 and debug_level >= DEBUG_LEVEL.INFO:
             TERM.write_failure("All clients disconected.")
 
+    # Polynomial staleness discount (FedBuff)
+    def staleness_weight(self, staleness):
+        return 1.0 / (1.0 + staleness) ** 0.5
+
+    # Send the latest model to the given clients and remember which version they are training on
+    def dispatch_model(self, client_addrs):
+        if len(client_addrs) == 0:
+            return
+
+        self.send_model(client_addrs)
+        for addr in client_addrs:
+            self.dispatched_versions[addr] = self.model_version
+
+    # Apply the (weighted) average of the buffered deltas as a new model version
+    def apply_buffered_updates(self):
+        RECORDER.set_round(self.trainer.round)
+        RECORDER.record_memory()
+
+        delta = self.trainer.finalize_aggregation()
+        weights = self.version_weights[self.model_version] + self.server_lr * delta.to(self.version_weights[self.model_version].device)
+
+        self.update_model(weights)
+        self.model_version += 1
+        self.rounds_completed += 1
+        self.version_weights[self.model_version] = self.trainer.flat_state()
+
+    # Weights the clients of a model version trained from: as they rebuilt them from the broadcast diffs,
+    # else as kept in memory while clients train on it, else from a checkpoint
+    def base_weights(self, version):
+        if self.model_cache is not None and version in self.model_cache.versions:
+            return self.model_cache.versions[version][0]
+        if version in self.version_weights:
+            return self.version_weights[version]
+        return self.checkpoints.load(version).to(self.trainer.device())
+
+    # Resume from the latest checkpoint (if any), returning whether one was found
+    def resume(self):
+        version = self.checkpoints.latest() if self.checkpoints is not None else None
+        if version is None:
+            return False
+
+        metadata = self.checkpoints.metadata(version)
+        self.trainer.model.load_state_dict(self.trainer.layout.as_state_dict(self.checkpoints.load(version)))
+        self.trainer.round = version
+        self.model_version = version
+        self.rounds_completed = metadata.get('rounds_completed', version)
+
+        # the server optimizer continues from its saved state (if it is the same optimizer).
+        optimizer = self.trainer.optimizer
+        if optimizer is not None and len(optimizer.STATE) > 0:
+            state = self.checkpoints.load_state(version)
+            if state is not None and metadata.get('optimizer') == str(optimizer):
+                optimizer.load_state_buffers(state, self.trainer.flat_state())
+            elif debug_level >= DEBUG_LEVEL.WARNS:
+                TERM.write_warning('Checkpoint {} has no state for {}: starting it from scratch.'.format(version, optimizer))
+
+        if debug_level >= DEBUG_LEVEL.INFO:
+            TERM.write_success('Resumed from checkpoint {} ({} rounds completed).'.format(version, self.rounds_completed))
+
+        return True
+
     ### FL Training Loop ###
 
-    # Randomly select subset of all client to train on
-    # TODO: Customizable random selection
+    # Removes the specified client (and its part in the current round) if it exists.
+    def remove_client(self, addr):
+        sock = self.connected_clients_by_addr.get(addr)
+        super(FLServer, self).remove_client(addr)
+
+        if addr in self.selected_clients_by_addr and addr not in self.selected_clients_updates:
+            self.selected_clients_by_addr.pop(addr)
+            self.selected_clients_by_sock.pop(sock, None)
+            self.round_target = min(self.round_target, len(self.selected_clients_by_addr))
+
+        # (a straggler that never replied took at least until now)
+        if self.straggling_clients.pop(addr, None) is not None:
+            self.scheduler.record_result(self.client_identity(addr), time.time())
+        self.dispatched_versions.pop(addr, None)
+
+        # clients with a session keep their scheduling history and model version (they may reconnect).
+        if self.session_by_addr.pop(addr, None) is None:
+            self.scheduler.remove_client(addr)
+            self.client_versions.pop(addr, None)
+
+    # Identity of a client: its session if it has one (stable across reconnects), else its address
+    def client_identity(self, addr):
+        return self.session_by_addr.get(addr, addr)
+
+    # Associate a (re)connected client with its session, evicting the connection it replaces
+    def register_session(self, addr, session):
+        old_addr = self.sessions.get(session)
+        if old_addr is not None and old_addr != addr and old_addr in self.connected_clients_by_addr:
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write_info('Session {} reconnected from {}'.format(session, addr))
+            self.session_by_addr.pop(old_addr, None)
+            self.remove_client(old_addr)
+
+        self.sessions[session] = addr
+        self.session_by_addr[addr] = session
+
+    # Receive a client's message, handling connection management (returns the message and whether it was handled)
+    def recv_from_client(self, addr, sock):
+        msg = Communication_Handler.recv_msg(sock)
+        if msg is None:
+            return None, False
+
+        self.last_seen[addr] = time.time()
+
+        control = Communication_Handler.control_msg(msg)
+        if control == 'hello':
+            self.register_session(addr, msg['session'])
+
+        # the model version the client holds (from its hello or its update). A model sent to the connection
+        # before its hello was read was recorded under its address, and is newer than what the hello reports.
+        if isinstance(msg, dict) and 'version' in msg:
+            version = msg['version']
+            if control == 'hello' and addr in self.client_versions:
+                version = self.client_versions.pop(addr)
+            self.client_versions[self.client_identity(addr)] = version
+
+        return msg, control in ('heartbeat', 'hello')
+
+    # Remove the clients that have not been heard from in HEARTBEAT_TIMEOUT seconds
+    def evict_dead_clients(self):
+        now = time.time()
+        for addr, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.HEARTBEAT_TIMEOUT:
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('No heartbeat from {} for {:0.0f}s: evicting it.'.format(addr, now - last_seen))
+                self.remove_client(addr)
+
+    # Select subset of all client to train on (using the scheduler's policy)
     def select_clients(self, subset_size):
+        # start a fresh running aggregate for this round.
+        self.trainer.begin_aggregation()
+
         with self.client_lock:
-            num_clients = len(self.connected_clients_by_addr)
-            selected_client_addrs = sample(self.connected_clients_by_addr.keys(), min(subset_size, num_clients))
+            # clients still busy with a cancelled update can't be selected.
+            available_addrs = [addr for addr in self.connected_clients_by_addr.keys() if addr not in self.straggling_clients]
+            num_selected = min(int(math.ceil(subset_size * self.over_selection)), len(available_addrs))
+
+            addrs_by_identity = { self.client_identity(addr) : addr for addr in available_addrs }
+            selected_client_addrs = [addrs_by_identity[identity] for identity in self.scheduler.select(list(addrs_by_identity.keys()), num_selected, self.rounds_completed)]
             for addr in selected_client_addrs:
                 sock = self.connected_clients_by_addr[addr]
                 self.selected_clients_by_addr[addr] = sock
                 self.selected_clients_by_sock[sock] = addr
 
+            # aggregate as soon as this many updates have arrived.
+            self.round_target = min(subset_size, num_selected)
+
     # Broadcast model to selected clients so they can train
     def broadcast_model(self):
         # Verify there are clients
         if len(self.selected_clients_by_addr) > 0:
-            self.broadcast(self.selected_clients_by_addr.keys(), self.trainer.model.state_dict())
+            self.send_model(self.selected_clients_by_addr.keys())
             return True
 
         return False
 
-    # Retrieve updates of selected clients
-    def wait_for_updates(self):
-        # attempt to get a message from more clients.
-        readable_clients_socks, _, _ = select.select(self.selected_clients_by_addr.values(), [], [])
+    # Send the current model to the given clients
+    def send_model(self, client_addrs):
+        self.scheduler.record_dispatch([self.client_identity(addr) for addr in client_addrs])
+        self.trainer.delta_base = None
+
+        # publish each model once; the clients only receive the segment's name and version.
+        if self.shared_memory:
+            if self.publisher is None:
+                self.publisher = shm_transport.SharedModelPublisher(self.trainer.layout.numel, self.shm_retain)
+            if self.published_round != self.trainer.round:
+                self.published_weights = self.publisher.publish(self.trainer.flat_state(), self.trainer.round)
+                self.published_round = self.trainer.round
+
+            return self.broadcast(client_addrs, self.published_weights)
+
+        if self.model_cache is None:
+            return self.broadcast(client_addrs, self.trainer.flat_state())
+
+        # one message per version the clients hold (a diff from it, or the full weights if it is unknown).
+        version = self.trainer.round
+        self.model_cache.add(version, self.trainer.flat_state())
+
+        # the clients train from the weights as they rebuild them (their deltas are relative to those).
+        self.trainer.delta_base = self.model_cache.versions[version][0]
+
+        clients_by_version = {}
+        for addr in client_addrs:
+            clients_by_version.setdefault(self.client_versions.get(self.client_identity(addr)), []).append(addr)
+
+        broadcast_stats = {}
+        for base, addrs in clients_by_version.items():
+            broadcast_stats.update(self.broadcast(addrs, self.model_cache.message(version, base)))
+
+        # the clients hold this version from now on (whether they then send an update or cancel).
+        for addr, (_, nbytes) in broadcast_stats.items():
+            if nbytes > 0:
+                self.client_versions[self.client_identity(addr)] = version
+
+        self.broadcast_stats = broadcast_stats
+        return broadcast_stats
+
+    # Retrieve updates of selected clients (folding each into the running aggregate as it arrives)
+    def wait_for_updates(self, timeout=None):
+        start = time.time()
+        num_updates = len(self.selected_clients_updates)
+
+        # attempt to get a message from more clients (also reading other clients' heartbeats and stragglers' late replies).
+        pending_socks = [sock for addr, sock in self.selected_clients_by_addr.items() if addr not in self.selected_clients_updates]
+        with self.client_lock:
+            other_socks = [sock for sock in self.connected_clients_by_sock if sock not in self.selected_clients_by_sock]
+
+        readable_clients_socks, _, _ = select.select(pending_socks + other_socks, [], [], timeout)
         for sock in readable_clients_socks:
-            self.selected_clients_updates[self.selected_clients_by_sock[sock]] = Communication_Handler.recv_msg(sock)
-    
-    # Aggregate Updates once the subset of selected clients are ready
+            addr = self.connected_clients_by_sock.get(sock)
+            if addr is None:
+                continue
+
+            msg, handled = self.recv_from_client(addr, sock)
+
+            if msg is None:
+                # the client is gone; don't wait for it this round.
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('Connection to {} lost: removing it.'.format(addr))
+                self.remove_client(addr)
+                continue
+
+            if handled:
+                continue
+
+            if addr not in self.selected_clients_by_addr or addr in self.selected_clients_updates:
+                # a straggler's late reply (its update or its cancellation acknowledgement): drop it,
+                # but let the scheduler see how long the client really took (past the round's end).
+                if self.straggling_clients.pop(addr, None) is not None:
+                    self.scheduler.record_result(self.client_identity(addr), time.time(), msg.get('stats') if isinstance(msg, dict) else None)
+                continue
+
+            if Communication_Handler.control_msg(msg) is not None:
+                # the client gave up on its update; don't wait for it this round.
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('No update from {}: dropping it from the round.'.format(addr))
+                self.selected_clients_by_addr.pop(addr)
+                self.selected_clients_by_sock.pop(sock)
+                self.round_target = min(self.round_target, len(self.selected_clients_by_addr))
+                continue
+
+            self.scheduler.record_result(self.client_identity(addr), time.time(), msg.get('stats') if isinstance(msg, dict) else None)
+
+            update, num_samples = Communication_Handler.unpack_update(msg)
+            self.accumulate_update(addr, update, num_samples)
+            self.selected_clients_updates[addr] = num_samples
+
+        self.evict_dead_clients()
+
+        RECORDER.record('wait_for_updates', start, time.time() - start, { 'updates' : len(self.selected_clients_updates) - num_updates })
+
+    # Aggregate Updates once enough of the selected clients are ready (returns whether they were)
     def attempt_to_aggregate_updates(self):
-        # check if all clients have provided data.
-        if len(self.selected_clients_updates) == len(self.selected_clients_by_addr):
-            # Aggregate the updates.
-            self.aggregated_update = self.trainer.aggregate(self.selected_clients_updates.values())
+        # check if the first round_target clients have provided data.
+        if len(self.selected_clients_updates) > 0 and len(self.selected_clients_updates) >= self.round_target:
+            # Finalize the (weighted) average of the updates.
+            self.aggregated_update = self.finalize_updates()
+            return True
+
+        return False
+
+    # Fold a selected client's update into the running aggregate
+    def accumulate_update(self, addr, update, num_samples):
+        self.trainer.accumulate(update, num_samples)
+
+    # (Weighted) average of the updates folded in this round
+    def finalize_updates(self):
+        return self.trainer.finalize_aggregation()
+
+    # Ask the selected clients that have not replied to drop their update (they are busy until they reply)
+    def cancel_pending_clients(self):
+        for addr, sock in self.selected_clients_by_addr.items():
+            if addr in self.selected_clients_updates:
+                continue
+
+            Communication_Handler.send_msg(sock, Communication_Handler.CANCEL_MSG)
+            self.straggling_clients[addr] = sock
 
     # Update server model (centralized model)
     def update_model(self, aggregated_update):
-        self.trainer.update(aggregated_update)
+        with RECORDER.span('update_model'):
+            self.trainer.update(aggregated_update)
+
+        # checkpoint the new version (written in the background).
+        if self.checkpoints is not None and self.checkpoints.should_save(self.trainer.round):
+            optimizer = self.trainer.optimizer
+            self.checkpoints.save(self.trainer.round, self.trainer.flat_state(), { 'rounds_completed' : self.rounds_completed + 1, 'optimizer' : str(optimizer) if optimizer is not None else None },
+                                  optimizer.state_buffers() if optimizer is not None else None)
+
+# FL server that only learns the sum of each group of clients' updates (secure aggregation with pairwise masks).
+# The clients send their full weights, masked; their public keys come with their hello.
+class SecureFLServer(FLServer):
+    def __init__(self, host, trainer, group_size=32):
+        super(SecureFLServer, self).__init__(host, trainer)
+
+        # Clients per masking group (each client agrees keys and expands masks for its group only).
+        self.group_size = group_size
+
+        # Public key of each session, and the current round's masked sums.
+        self.public_keys = {}
+        self.aggregator = None
+
+        # Round ids only increase (also across server restarts), so the clients never reuse a mask.
+        self.secure_round = int(time.time() * 1000)
+
+        # Time the survivors have to reveal their secrets (in seconds).
+        self.UNMASK_TIMEOUT = 10
+
+    def recv_from_client(self, addr, sock):
+        msg, handled = super(SecureFLServer, self).recv_from_client(addr, sock)
+
+        control = Communication_Handler.control_msg(msg)
+        if control == 'hello' and msg.get('public_key') is not None:
+            self.public_keys[msg['session']] = msg['public_key']
+
+        # (reveals arriving after the unmasking deadline are dropped)
+        return msg, handled or control == 'secagg_reveal'
+
+    # (the masks only cancel within a round's groups)
+    def train_async(self):
+        raise NotImplementedError('Secure aggregation needs synchronous rounds')
+
+    # Split the clients into masking groups, tell each group its members, then send the model
+    def send_model(self, client_addrs):
+        client_addrs = list(client_addrs)
+
+        # (sorted by session, so groups and the keys agreed within them mostly repeat across rounds)
+        members = sorted(self.client_identity(addr) for addr in client_addrs if self.client_identity(addr) in self.public_keys)
+        groups = secure_aggregation.make_groups(members, self.group_size) if len(members) >= 2 else []
+        grouped = set(member for group in groups for member in group)
+
+        # clients that can't be masked (no key, or alone) sit this round out.
+        for addr in client_addrs:
+            if self.client_identity(addr) not in grouped:
+                if debug_level >= DEBUG_LEVEL.WARNS:
+                    TERM.write_warning('{} can\'t take part in a secure round: dropping it from the round.'.format(addr))
+                sock = self.selected_clients_by_addr.pop(addr, None)
+                self.selected_clients_by_sock.pop(sock, None)
+                self.round_target = min(self.round_target, len(self.selected_clients_by_addr))
+
+        self.secure_round += 1
+        self.aggregator = secure_aggregation.SecureAggregator(self.secure_round, groups, self.trainer.layout.numel + 1)
+
+        for group in groups:
+            msg = { 'control' : 'secagg_group', 'round' : self.secure_round, 'members' : [(member, self.public_keys[member]) for member in group] }
+            self.broadcast([self.sessions[member] for member in group], msg)
+
+        client_addrs = [addr for addr in client_addrs if self.client_identity(addr) in grouped]
+        return super(SecureFLServer, self).send_model(client_addrs) if client_addrs else {}
+
+    def accumulate_update(self, addr, update, num_samples):
+        if not isinstance(update, dict) or 'masked' not in update or not self.aggregator.add(self.client_identity(addr), update):
+            if debug_level >= DEBUG_LEVEL.WARNS:
+                TERM.write_warning('Ignoring an update from {} that is not masked for this round.'.format(addr))
+
+    # Ask the survivors to reveal their secrets, and unmask the sum
+    def finalize_updates(self):
+        with RECORDER.span('secure_unmask') as span:
+            requests = self.aggregator.unmask_requests()
+
+            pending = {}
+            for member, msg in requests.items():
+                addr = self.sessions.get(member)
+                sock = self.connected_clients_by_addr.get(addr)
+                if sock is not None and Communication_Handler.send_msg(sock, msg):
+                    pending[sock] = (addr, member)
+
+            deadline = time.time() + self.UNMASK_TIMEOUT
+            while len(pending) > 0 and time.time() < deadline:
+                readable_socks, _, _ = select.select(list(pending.keys()), [], [], deadline - time.time())
+                for sock in readable_socks:
+                    addr, member = pending[sock]
+                    msg, _ = self.recv_from_client(addr, sock)
+
+                    if msg is None:
+                        pending.pop(sock)
+                        self.remove_client(addr)
+                    elif Communication_Handler.control_msg(msg) == 'secagg_reveal':
+                        pending.pop(sock)
+                        self.aggregator.reveal(member, msg)
+
+            aggregated_update = self.aggregator.finalize()
+            span.set(requests=len(requests), missing=len(pending))
+
+        return None if aggregated_update is None else aggregated_update.to(self.trainer.device())
 
 ### Main Code ###
 
@@ -192,8 +769,41 @@ if __name__ == '__main__':
     server_hostname = socket.gethostbyname('localhost')
     server_port = 8080
 
+    # Evaluation precision mode (e.g. --precision=bf16+channels_last, compared with float32 each round),
+    # secure aggregation (--secure, or --secure=16 for masking groups of 16 clients; the clients need --secure too)
+    # round deadlines (e.g. --deadline=30 seconds, with --over-selection=1.3 and --min-updates=2 to aggregate what arrived by then)
+    # and the trace buffer size (e.g. --trace-events=1000000).
+    precision_mode = None
+    group_size = None
+    deadline = None
+    over_selection = None
+    min_updates = None
+    for arg in sys.argv:
+        if arg.startswith('--precision='):
+            precision_mode = precision.make_precision(arg.split('=', 1)[1])
+        elif arg == '--secure' or arg.startswith('--secure='):
+            group_size = int(arg.split('=', 1)[1]) if '=' in arg else 32
+        elif arg.startswith('--deadline='):
+            deadline = float(arg.split('=', 1)[1])
+        elif arg.startswith('--over-selection='):
+            over_selection = float(arg.split('=', 1)[1])
+        elif arg.startswith('--min-updates='):
+            min_updates = int(arg.split('=', 1)[1])
+        elif arg.startswith('--trace-events='):
+            RECORDER.set_capacity(int(arg.split('=', 1)[1]))
+
     # Initialize the FL server.
-    flServer = FLServer((server_hostname, server_port),  server_trainer.ServerTrainer())
+    if group_size is None:
+        flServer = FLServer((server_hostname, server_port),  server_trainer.ServerTrainer(precision=precision_mode))
+    else:
+        flServer = SecureFLServer((server_hostname, server_port),  server_trainer.ServerTrainer(precision=precision_mode), group_size)
+
+    if deadline is not None:
+        flServer.TIMEOUT = deadline
+    if over_selection is not None:
+        flServer.over_selection = over_selection
+    if min_updates is not None:
+        flServer.min_updates = min_updates
 
     # Allow client to connect
     flServer.start()
@@ -208,4 +818,44 @@ if __name__ == '__main__':
         # Train the FL server model.
         TERM.write_warning('Time limit exceeded: ' + str(len(flServer.connected_clients_by_addr)) + ' client(s) connected.')
         TERM.write_info("Starting FL training loop...")
-        flServer.train()
+
+        # Clients on this host can map the weights from shared memory.
+        flServer.shared_memory = '--shm' in sys.argv
+
+        # Client selection policy (e.g. --scheduler=throughput), checkpoints (e.g. --checkpoint-every=5), model diffs (e.g. --broadcast=fp16)
+        # and server optimizer (e.g. --server-opt=adam or --server-opt=avgm,lr=1.0,momentum=0.9).
+        for arg in sys.argv:
+            if arg.startswith('--server-opt='):
+                flServer.trainer.optimizer = server_optimizer.make_optimizer(arg.split('=', 1)[1])
+            elif arg.startswith('--scheduler='):
+                flServer.scheduler = scheduler.make_scheduler(arg.split('=', 1)[1], deadline)
+            elif arg.startswith('--checkpoint-every='):
+                flServer.checkpoints = checkpoint.CheckpointStore(every=int(arg.split('=', 1)[1]))
+            elif arg.startswith('--broadcast='):
+                # model diffs encoding ('fp32', the default, or the lossy 'fp16' and 'int8'), or 'full' to always send the full weights.
+                quantize = arg.split('=', 1)[1]
+                flServer.model_cache = None if quantize == 'full' else model_cache.ModelCache(quantize=None if quantize == 'fp32' else quantize)
+
+        # Continue from the latest checkpoint (read only, unless --checkpoint-every is given too).
+        if '--resume' in sys.argv:
+            if flServer.checkpoints is None:
+                flServer.checkpoints = checkpoint.CheckpointStore(every=0)
+            flServer.resume()
+
+        try:
+            # Asynchronous (buffered) rounds, or synchronous ones.
+            if '--async' in sys.argv:
+                flServer.train_async()
+            else:
+                flServer.train()
+        finally:
+            if flServer.publisher is not None:
+                flServer.publisher.close()
+            if flServer.checkpoints is not None:
+                flServer.checkpoints.close()
+
+            # Keep the selection decisions (predicted vs actual latency) for tuning.
+            flServer.scheduler.export('./train_curves/Scheduler.jsonl')
+
+            # Where each round's time went (JSON lines, and a Chrome trace).
+            RECORDER.export('./train_curves/Server_trace')
@@ -0,0 +1,129 @@
+import torch
+
+# Server-side optimizers (Reddi et al., Adaptive Federated Optimization): the round's aggregate minus the
+# current weights is a pseudo-gradient, and the server takes a step along it instead of replacing the weights.
+# The state lives in flat buffers (the layout of the weights), updated in place with fused ops.
+class ServerOptimizer():
+    # State buffers carried across rounds (saved with the checkpoints)
+    STATE = []
+
+    def __init__(self, lr=1.0):
+        self.lr = lr
+
+        # pseudo-gradient of the last step (reused every round)
+        self.delta = None
+
+    # Take a step (in place) from the flat weights towards the aggregate
+    def step(self, weights, aggregate):
+        if self.delta is None:
+            self.init_state(weights)
+
+        torch.sub(aggregate, weights, out=self.delta)
+        self.apply(weights, self.delta)
+
+    # Allocate the state buffers (shaped like the weights)
+    def init_state(self, weights):
+        self.delta = torch.zeros_like(weights)
+
+    def apply(self, weights, delta):
+        weights.add_(delta, alpha=self.lr)
+
+    # The state buffers by name (none before the first step)
+    def state_buffers(self):
+        if self.delta is None:
+            return {}
+        return { name : getattr(self, name) for name in self.STATE }
+
+    # Restore state buffers (e.g. from a checkpoint) for the given flat weights
+    def load_state_buffers(self, buffers, weights):
+        self.init_state(weights)
+        for name in self.STATE:
+            getattr(self, name).copy_(buffers[name])
+
+    def __str__(self):
+        return 'avg(lr={})'.format(self.lr)
+
+# FedAvgM: server momentum (m = momentum * m + delta, w += lr * m)
+class FedAvgM(ServerOptimizer):
+    STATE = ['momentum_buffer']
+
+    def __init__(self, lr=1.0, momentum=0.9):
+        super(FedAvgM, self).__init__(lr)
+        self.momentum = momentum
+        self.momentum_buffer = None
+
+    def init_state(self, weights):
+        super(FedAvgM, self).init_state(weights)
+        self.momentum_buffer = torch.zeros_like(weights)
+
+    def apply(self, weights, delta):
+        self.momentum_buffer.mul_(self.momentum).add_(delta)
+        weights.add_(self.momentum_buffer, alpha=self.lr)
+
+    def __str__(self):
+        return 'avgm(lr={}, momentum={})'.format(self.lr, self.momentum)
+
+# FedAdam: w += lr * m / (sqrt(v) + tau), with m and v the moving averages of the pseudo-gradient and its square
+class FedAdam(ServerOptimizer):
+    STATE = ['first_moment', 'second_moment']
+
+    def __init__(self, lr=0.01, beta1=0.9, beta2=0.99, tau=1e-3):
+        super(FedAdam, self).__init__(lr)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.tau = tau
+
+        self.first_moment = None
+        self.second_moment = None
+        self.scratch = None
+
+    def init_state(self, weights):
+        super(FedAdam, self).init_state(weights)
+        self.first_moment = torch.zeros_like(weights)
+        self.second_moment = torch.full_like(weights, self.tau ** 2)
+        self.scratch = torch.zeros_like(weights)
+
+    def apply(self, weights, delta):
+        self.first_moment.lerp_(delta, 1 - self.beta1)
+        self.update_second_moment(delta)
+
+        denominator = torch.sqrt(self.second_moment, out=self.scratch).add_(self.tau)
+        weights.addcdiv_(self.first_moment, denominator, value=self.lr)
+
+    def update_second_moment(self, delta):
+        self.second_moment.mul_(self.beta2).addcmul_(delta, delta, value=1 - self.beta2)
+
+    def __str__(self):
+        return '{}(lr={}, beta1={}, beta2={}, tau={})'.format(type(self).__name__[3:].lower(), self.lr, self.beta1, self.beta2, self.tau)
+
+# FedYogi: FedAdam whose second moment moves additively (v -= (1 - beta2) * delta^2 * sign(v - delta^2)),
+# so it grows no faster than the squared pseudo-gradients
+class FedYogi(FedAdam):
+    def update_second_moment(self, delta):
+        squared = torch.mul(delta, delta, out=self.scratch)
+
+        # (the pseudo-gradient is not needed anymore: its buffer holds the sign)
+        sign = torch.sub(self.second_moment, squared, out=delta).sign_()
+        self.second_moment.addcmul_(squared, sign, value=-(1 - self.beta2))
+
+OPTIMIZERS = { 'avg' : ServerOptimizer, 'avgm' : FedAvgM, 'adam' : FedAdam, 'yogi' : FedYogi }
+
+# Build a server optimizer from a spec: a name ('avg', 'avgm', 'adam', 'yogi') optionally followed by
+# comma separated settings (e.g. 'adam,lr=0.01,beta2=0.999'); None or 'avg' replaces the weights with the aggregate
+def make_optimizer(spec):
+    if spec is None:
+        return None
+
+    name, _, settings = spec.partition(',')
+    if name not in OPTIMIZERS:
+        raise ValueError('Unknown server optimizer \'{}\''.format(name))
+
+    kwargs = {}
+    for setting in settings.split(',') if settings else []:
+        key, value = setting.split('=', 1)
+        kwargs[key] = float(value)
+
+    if name == 'avg' and kwargs.get('lr', 1.0) == 1.0:
+        return None
+
+    return OPTIMIZERS[name](**kwargs)
@@ -8,118 +8,289 @@ np.set_printoptions(formatter={'float': lambda x: "{0:0.2f}".format(x)})
 
 import utils
 from utils import DEBUG_LEVEL, TERM
+from instrumentation import RECORDER
 
 debug_level = DEBUG_LEVEL.INFO
 
-import sys, csv
+import sys, csv, copy, time, threading
+from concurrent.futures import ThreadPoolExecutor
 
 import model1
+import data_prep
+from flat_params import FlatLayout
+import update_codec
+import evaluation
 
 # Class encapsulating Training program for the Server's model
 class ServerTrainer():
-    def __init__(self, use_cuda=True):
-        # Model
-        self.model = model1.Net()
+    def __init__(self, use_cuda=True, num_workers=4, async_eval=True, model_fn=None, cpu_profile=None, precision=None, eval_every=1, eval_subset=None):
+        # Model (model_fn builds another architecture, e.g. for benchmarks)
+        self.model = model1.Net() if model_fn is None else model_fn()
 
         # Test Data
         self.test_loader = self.load_test_data()
         self.test_acc = [ ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9'] ]
 
-        # Enable CUDA
+        # Evaluation: every N rounds, optionally on a fixed random subset of the test set
+        # (read once, when the evaluator is built)
+        self.round = 0
+        self.eval_every = eval_every
+        self.eval_subset = eval_subset
+        self.evaluator = evaluation.Evaluator(self.test_loader, every=self.eval_every, subset=self.eval_subset)
+
+        # Test accuracy log (None disables it)
+        self.csv_path = './train_curves/Server.csv'
+
+        # Enable CUDA (decided once)
         self.use_cuda = use_cuda
-        if self.use_cuda and torch.cuda.is_available():
-            self.model = self.model.cuda()
+        self.model_device = torch.device('cuda' if self.use_cuda and torch.cuda.is_available() else 'cpu')
+        self.model = self.model.to(self.model_device)
+
+        # CPU threads / cores of the server (aggregation and evaluation)
+        self.cpu_profile = cpu_profile
+        if self.cpu_profile is not None:
+            self.cpu_profile.apply()
+
+        # Flat parameter layout (shared by aggregation and transport)
+        self.layout = FlatLayout(self.model.state_dict())
+
+        # Reduction pool: each update is added shard by shard (torch ops release the GIL),
+        # so several updates are reduced at once while the network loop keeps receiving
+        self.num_workers = num_workers
+        self.reduce_pool = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.shard_locks = [threading.Lock() for _ in range(max(1, num_workers))]
+        self.pending_reductions = []
+
+        # Updates queued for reduction (each holds a full update in memory) before accumulate blocks
+        self.max_pending_reductions = 2 * max(1, num_workers)
+        self.num_reductions = 0
+
+        # Evaluation of round t runs on a copy of the model while round t+1 is broadcast
+        self.eval_pool = ThreadPoolExecutor(max_workers=1) if async_eval else None
+        self.eval_model = copy.deepcopy(self.model) if async_eval else None
+        self.pending_evaluations = []
+
+        # Reduced precision evaluation (None runs in float32), compared with float32 each round
+        self.precision = precision
+        self.forward_model = self.model if precision is None else precision.prepare(self.model)
+        self.eval_forward_model = self.eval_model if precision is None or self.eval_model is None else precision.prepare(self.eval_model)
+        self.precision_csv_path = './train_curves/Precision.csv'
+
+        # Server optimizer stepping along the pseudo-gradient (None replaces the weights with the aggregate)
+        self.optimizer = None
+
+        # Weights the clients trained from this round, when they differ from the model's (e.g. rebuilt from
+        # quantized diffs); encoded (delta) updates are relative to them. None uses the model's weights.
+        self.delta_base = None
+
+        # Running aggregate of the current round's updates
+        self.begin_aggregation()
 
     ### Training Program ###
 
-    # Aggregate updates into a single update
-    def aggregate(self, updates):
-        # Zero the state
-        aggregate_update = self.get_zero_state()
+    # Aggregate updates into a single update (one batched reduction over the flat buffers)
+    def aggregate(self, updates, weights=None):
+        with RECORDER.span('aggregate', updates=len(updates)):
+            flats = torch.stack([self.decode_update(update).to(self.device()) for update in updates])
+
+            if weights is None:
+                return flats.mean(0)
+
+            weights = torch.tensor(weights, dtype=flats.dtype, device=flats.device)
+            return (weights @ flats) / weights.sum()
+
+    # Start a new running (weighted) sum of updates
+    def begin_aggregation(self):
+        # Reductions still running belong to the previous sum
+        self.wait_for_reductions()
+
+        self.aggregate_sum = None
+        self.aggregate_weight = 0.0
+
+        # Total weight of encoded (delta) updates, whose base is added back once
+        self.aggregate_delta_weight = 0.0
+
+    # Fold a single update into the running sum (the update can be freed afterwards);
+    # normalizer is its share of the average's denominator (its weight, unless e.g. a discount must not cancel out)
+    def accumulate(self, update, weight=1.0, normalizer=None):
+        if self.aggregate_sum is None:
+            self.aggregate_sum = self.layout.zeros(self.device())
+
+        encoded = update_codec.is_encoded(update)
+        if encoded:
+            # Encoded updates are deltas against the weights broadcast this round
+            self.aggregate_delta_weight += weight
+
+        self.aggregate_weight += weight if normalizer is None else normalizer
+
+        if self.reduce_pool is None:
+            self.reduce_update(update, weight, encoded)
+        else:
+            # backpressure: wait for the oldest reduction rather than queueing updates without bound
+            while len(self.pending_reductions) >= self.max_pending_reductions:
+                self.pending_reductions.pop(0).result()
+
+            self.pending_reductions.append(self.reduce_pool.submit(self.reduce_update_sharded, update, weight, encoded, self.num_reductions, time.time()))
+            self.num_reductions += 1
+
+    # Add an update into the running sum
+    def reduce_update(self, update, weight, encoded):
+        if encoded:
+            update_codec.decode_delta_into(update, self.aggregate_sum, weight)
+        else:
+            self.aggregate_sum.add_(self.layout.as_flat(update).to(self.aggregate_sum.device), alpha=weight)
+
+    # Add an update into the running sum one shard at a time (starting from a different shard per update)
+    def reduce_update_sharded(self, update, weight, encoded, start_shard, submit_time=None):
+        start = time.time()
+
+        if encoded:
+            flat = update_codec.decode_delta_into(update, self.layout.zeros(self.aggregate_sum.device))
+        else:
+            flat = self.layout.as_flat(update).to(self.aggregate_sum.device)
 
-        for key in aggregate_update:
-            # Accumulate the updates
-            for update in updates:
-                aggregate_update[key] += update[key]
+        num_shards = len(self.shard_locks)
+        shard_size = (self.layout.numel + num_shards - 1) // num_shards
 
-            # Average
-            aggregate_update[key] /= len(updates)
+        for i in range(num_shards):
+            shard = (start_shard + i) % num_shards
+            begin, end = shard * shard_size, min(self.layout.numel, (shard + 1) * shard_size)
 
+            with self.shard_locks[shard]:
+                self.aggregate_sum[begin:end].add_(flat[begin:end], alpha=weight)
+
+        # (queue wait: time spent behind other reductions in the pool)
+        RECORDER.record('reduce', start, time.time() - start, { 'queue_wait' : start - submit_time if submit_time is not None else 0.0 })
+
+    # Wait until every submitted update has been reduced
+    def wait_for_reductions(self):
+        pending, self.pending_reductions = self.pending_reductions, []
+        for future in pending:
+            future.result()
+
+    # Turn the running sum into the (weighted) average (a flat buffer)
+    def finalize_aggregation(self):
+        start = time.time()
+
+        self.wait_for_reductions()
+        aggregate_update = self.aggregate_sum
+
+        if aggregate_update is not None and self.aggregate_weight > 0:
+            if self.aggregate_delta_weight > 0:
+                aggregate_update.add_(self.base_state(), alpha=self.aggregate_delta_weight)
+
+            aggregate_update.div_(self.aggregate_weight)
+
+        RECORDER.record('aggregate', start, time.time() - start, { 'weight' : self.aggregate_weight })
+
+        self.begin_aggregation()
         return aggregate_update
 
     # Apply the aggregate update to the model
     def update(self, aggregate_update):
-        self.model.load_state_dict(aggregate_update)
-
+        if self.optimizer is None:
+            self.model.load_state_dict(self.layout.as_state_dict(aggregate_update))
+        else:
+            with RECORDER.span('server_step', optimizer=str(self.optimizer)):
+                weights = self.flat_state()
+                self.optimizer.step(weights, aggregate_update.to(weights.device))
+                self.model.load_state_dict(self.layout.as_state_dict(weights))
+
+        self.round += 1
+
+        if not self.evaluator.should_evaluate(self.round):
+            return
+
+        if self.eval_pool is None:
+            self.evaluate_round(self.round, self.model, self.forward_model)
+        else:
+            # Evaluate a snapshot in the background (in round order; flat_state is already a copy)
+            self.reap_evaluations()
+            self.pending_evaluations.append(self.eval_pool.submit(self.evaluate_snapshot, self.round, self.flat_state()))
+
+    # Evaluate a snapshot of the weights on the evaluation copy of the model
+    def evaluate_snapshot(self, round_idx, flat_weights):
+        self.eval_model.load_state_dict(self.layout.unflatten(flat_weights))
+        self.evaluate_round(round_idx, self.eval_model, self.eval_forward_model)
+
+    # Compute, log and save the test accuracy of a round (model runs through forward_model in the precision mode)
+    def evaluate_round(self, round_idx, model, forward_model=None):
         # Compute Accuracy (test)
-        acc = self.compute_accuracy(self.test_loader)
+        with RECORDER.span('evaluate', round=round_idx) as span:
+            acc, overall_acc = self.evaluator.evaluate(model if forward_model is None else forward_model, self.precision)
+            span.set(accuracy=overall_acc)
         self.test_acc.append(acc)
 
+        # Compare with float32 (the accuracy cost of the precision mode)
+        if self.precision is not None:
+            with RECORDER.span('evaluate_fp32', round=round_idx) as span:
+                _, overall_acc_fp32 = self.evaluator.evaluate(model)
+                span.set(accuracy=overall_acc_fp32)
+
+            if debug_level >= DEBUG_LEVEL.INFO:
+                TERM.write('\tAccuracy: {:0.2f} ({}) vs {:0.2f} (fp32)'.format(overall_acc, self.precision, overall_acc_fp32))
+
+            if self.precision_csv_path is not None:
+                self.save_to_csv([round_idx, str(self.precision), overall_acc, overall_acc_fp32], self.precision_csv_path)
+
         if debug_level >= DEBUG_LEVEL.INFO:
-            TERM.write('\tEpoch ' + str(len(self.test_acc) - 1) + '\n')
+            TERM.write('\tEpoch ' + str(round_idx) + '\n')
             TERM.write('\tClass Accuracies: {}'.format(100 * np.array(self.test_acc[-1])))
 
         # Occasionally save current test accuracy
-        self.save_to_csv(acc, './train_curves/Server.csv')
+        if self.csv_path is not None:
+            self.save_to_csv(acc, self.csv_path)
+
+    # Forget the background evaluations that are done (raising their errors, if any)
+    def reap_evaluations(self):
+        pending = []
+        for future in self.pending_evaluations:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.pending_evaluations = pending
+
+    # Wait until every background evaluation is done
+    def wait_for_evaluations(self):
+        pending, self.pending_evaluations = self.pending_evaluations, []
+        for future in pending:
+            future.result()
 
     ### Helper Functions ###
 
     # Creates an zero set of weights
     def get_zero_state(self):
-        model = model1.Net()
-        # Enable CUDA
-        if self.use_cuda and torch.cuda.is_available():
-            model = model.cuda()
+        return self.layout.unflatten(self.layout.zeros(self.device()))
 
-        state = model.state_dict()
+    # The model's weights as a single flat buffer
+    def flat_state(self):
+        return self.layout.flatten(self.model.state_dict())
 
-        # Iterate and set all weights to zero
-        for key in state:
-            state[key] *= 0.0
+    # Weights the clients of this round trained from (read only)
+    def base_state(self):
+        return self.flat_state() if self.delta_base is None else self.delta_base
 
-        return state
+    # Full flat weights of an update (decoding deltas against the weights the clients trained from)
+    def decode_update(self, update):
+        if update_codec.is_encoded(update):
+            return update_codec.decode_delta_into(update, self.flat_state() if self.delta_base is None else self.delta_base.clone())
+        return self.layout.as_flat(update)
 
-    # Load test dataset
-    def load_test_data(self):
-        composition = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5,), (0.5,))])
-        test_set = torchvision.datasets.MNIST(root='./data', train=False, download=True, transform=composition)
-
-        return DataLoader(test_set, batch_size=len(test_set.targets), shuffle=False)
-
-    # Compute per class accuracy
-    def compute_accuracy(self, data_loader):
-        # Cache results for each class
-        correct_by_class = torch.zeros(10)
-        total_by_class = torch.zeros(10)
-
-        # Enable CUDA
-        if self.use_cuda and torch.cuda.is_available():
-            correct_by_class = correct_by_class.cuda()
-            total_by_class = total_by_class.cuda()
-
-        for inputs, targets in data_loader:
-            # Enable CUDA
-            if self.use_cuda and torch.cuda.is_available():
-                inputs = inputs.cuda()
-                targets = targets.cuda()
+    # Flat delta of an update against the weights it was trained from
+    def delta_update(self, update, base):
+        if update_codec.is_encoded(update):
+            return update_codec.decode_delta_into(update, self.layout.zeros(self.device()))
+        return self.layout.as_flat(update).to(base.device) - base
 
-            # Compute predictions
-            with torch.no_grad():
-                outputs = self.model(inputs)
+    # Device the model lives on
+    def device(self):
+        return self.model_device
 
-            preds = outputs.max(1, keepdim=True)[1]
-
-            # determine the number correct per class.
-            labels, counts = torch.unique(targets[(preds.squeeze() == targets).nonzero()], return_counts=True)
-            correct_by_class[labels] += counts.float()
-
-            # determine the number per class.
-            labels, counts = torch.unique(targets, return_counts=True)
-            total_by_class[labels] += counts.float()
-
-        total_by_class[(total_by_class == 0).nonzero()] = 1.0 # TODO: Change this to be an NaN.
-
-        return (correct_by_class / total_by_class).cpu().tolist()
+    # Load test dataset
+    def load_test_data(self):
+        data_prep.prepare_mnist()
+        return data_prep.ShardLoader('test', shuffle=False)
 
     # Save data to CSV file
     def save_to_csv(self, data, file_path):
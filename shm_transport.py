@@ -0,0 +1,82 @@
+import os, collections
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import torch
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+
+debug_level = DEBUG_LEVEL.INFO
+
+# A float32 array living in a (named) shared memory segment
+class SharedArray():
+    def __init__(self, shape, name=None, untrack=False):
+        size = int(np.prod(shape)) * 4
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+            # Processes that did not create (or fork from the creator of) the segment must not
+            # let their resource tracker unlink it when they exit.
+            if untrack:
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.name = self.shm.name
+        self.array = np.ndarray(shape, dtype=np.float32, buffer=self.shm.buf)
+        self.tensor = torch.from_numpy(self.array)
+
+    def close(self):
+        del self.tensor, self.array
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+# Publishes each version of the global (flat) weights once into its own shared memory segment
+class SharedModelPublisher():
+    def __init__(self, numel, retain=2):
+        self.numel = numel
+        self.version = 0
+
+        # Recent versions (older ones are unlinked; readers that still map them keep a valid mapping)
+        self.retain = retain
+        self.segments = collections.OrderedDict()
+
+    # Publish flat weights (of the given round), returning the (tiny) notification to send to the clients
+    def publish(self, flat_weights, round_idx=None):
+        self.version += 1
+
+        segment = SharedArray((self.numel,))
+        segment.tensor.copy_(flat_weights)
+        self.segments[self.version] = segment
+
+        while len(self.segments) > self.retain:
+            _, old_segment = self.segments.popitem(last=False)
+            old_segment.unlink()
+
+        return { 'shm' : segment.name, 'version' : self.version, 'round' : round_idx, 'numel' : self.numel }
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.unlink()
+        self.segments.clear()
+
+# Whether a message is a shared memory weights notification
+def is_notification(msg):
+    return isinstance(msg, dict) and 'shm' in msg
+
+# Maps the published weights and hands them (zero-copy) to load, e.g. a trainer's load_weights,
+# returning its result (False if the version is not published anymore: the reader then asks for the weights again)
+def read_weights(notification, load):
+    try:
+        segment = SharedArray((notification['numel'],), notification['shm'], untrack=True)
+    except FileNotFoundError:
+        return False
+
+    try:
+        return load(segment.tensor)
+    finally:
+        segment.close()
@@ -0,0 +1,349 @@
+import os, sys, time, queue, argparse, functools, multiprocessing
+
+import numpy as np
+import torch
+
+import utils
+from utils import DEBUG_LEVEL, TERM
+
+import server
+from server import FLServer
+import server_trainer
+import client_trainer
+import data_prep
+import scheduler
+from shm_transport import SharedArray
+from batched_trainer import BatchedTrainer
+from cpu_profile import CPUProfile
+
+debug_level = DEBUG_LEVEL.INFO
+
+### Partitioning ###
+
+# Split the samples uniformly at random
+def partition_iid(labels, num_clients, rng):
+    return np.array_split(rng.permutation(len(labels)), num_clients)
+
+# Give each client a few digits (cyclically), splitting each digit's samples among its clients
+def partition_digits(labels, num_clients, rng, digits_per_client=2):
+    client_digits = [[(i * digits_per_client + j) % 10 for j in range(digits_per_client)] for i in range(num_clients)]
+
+    partitions = [[] for _ in range(num_clients)]
+    for digit in range(10):
+        owners = [i for i in range(num_clients) if digit in client_digits[i]]
+        if len(owners) == 0:
+            continue
+
+        samples = rng.permutation(np.nonzero(labels == digit)[0])
+        for owner, part in zip(owners, np.array_split(samples, len(owners))):
+            partitions[owner].append(part)
+
+    return [np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int64) for parts in partitions]
+
+# Split each digit's samples among the clients with Dirichlet(alpha) proportions (smaller alpha is less IID)
+def partition_dirichlet(labels, num_clients, rng, alpha=0.5):
+    partitions = [[] for _ in range(num_clients)]
+    for digit in range(10):
+        samples = rng.permutation(np.nonzero(labels == digit)[0])
+        proportions = rng.dirichlet(alpha * np.ones(num_clients))
+        splits = (np.cumsum(proportions) * len(samples)).astype(int)[:-1]
+
+        for client, part in enumerate(np.split(samples, splits)):
+            partitions[client].append(part)
+
+    return [np.concatenate(parts) for parts in partitions]
+
+# Partition the (cached) MNIST training set among the clients
+def make_partitions(scheme, num_clients, seed=0, **kwargs):
+    labels = np.load(os.path.join(data_prep.prepare_mnist(), 'train_labels.npy'))
+    rng = np.random.RandomState(seed)
+
+    if scheme == 'iid':
+        return partition_iid(labels, num_clients, rng)
+    elif scheme == 'digits':
+        return partition_digits(labels, num_clients, rng, **kwargs)
+    elif scheme == 'dirichlet':
+        return partition_dirichlet(labels, num_clients, rng, **kwargs)
+
+    raise ValueError('Unknown partitioning scheme \'{}\''.format(scheme))
+
+### Virtual Clients (run in the worker processes) ###
+
+# Per-process state of a simulation worker
+WORKER = None
+
+class SimulationWorker():
+    def __init__(self, partitions, numel, cores=None, num_threads=None, model_fn=None, proximal_mu=0.0):
+        self.partitions = partitions
+        self.numel = numel
+        self.model_fn = model_fn
+
+        # FedProx: weight of the clients' proximal term (0 trains plain SGD)
+        self.proximal_mu = proximal_mu
+
+        # Client trainers (created on first use), attached segments and the update segment of the latest task
+        self.trainers = {}
+        self.segments = {}
+        self.updates_name = None
+
+        # Pin to a core and keep torch from oversubscribing it
+        CPUProfile(intra_threads=num_threads, cores=cores).apply()
+
+        # Keep the virtual clients quiet
+        client_trainer.debug_level = DEBUG_LEVEL.ERRORS
+
+    def get_trainer(self, client_id):
+        if client_id not in self.trainers:
+            self.trainers[client_id] = client_trainer.ClientTrainer(None, use_cuda=False, indices=self.partitions[client_id], name='Sim{}'.format(client_id), eval_every=0, model_fn=self.model_fn)
+            self.trainers[client_id].proximal_mu = self.proximal_mu
+        return self.trainers[client_id]
+
+    def get_segment(self, name, shape):
+        if name not in self.segments:
+            self.segments[name] = SharedArray(shape, name)
+        return self.segments[name]
+
+    # The update segment of a task: the server retires a segment for a new one (tasks run one at a time
+    # in a worker), so the mapping of the previous one is closed
+    def get_updates_segment(self, name, shape):
+        if name != self.updates_name:
+            if self.updates_name is not None:
+                self.segments.pop(self.updates_name).close()
+            self.updates_name = name
+        return self.get_segment(name, shape)
+
+    # Train one client on the published weights and write its update into its slot
+    def run_client(self, client_id, weights_name, updates_name, slot, num_slots):
+        start = time.time()
+
+        trainer = self.get_trainer(client_id)
+        trainer.load_weights(self.get_segment(weights_name, (self.numel,)).tensor)
+        trainer.train()
+
+        self.get_updates_segment(updates_name, (num_slots, self.numel)).tensor[slot].copy_(trainer.focused_update())
+
+        return client_id, updates_name, slot, trainer.num_samples, time.time() - start, trainer.last_loss
+
+    # Train several clients at once (as one batched model) and write their updates into their slots
+    def run_clients(self, client_ids, weights_name, updates_name, slots, num_slots):
+        if len(client_ids) == 1:
+            return [self.run_client(client_ids[0], weights_name, updates_name, slots[0], num_slots)]
+
+        start = time.time()
+
+        trainers = [self.get_trainer(client_id) for client_id in client_ids]
+        weights = self.get_segment(weights_name, (self.numel,)).tensor
+        for trainer in trainers:
+            trainer.load_weights(weights)
+
+        updates = self.get_updates_segment(updates_name, (num_slots, self.numel)).tensor
+        updates.index_copy_(0, torch.tensor(slots), BatchedTrainer(trainers).train())
+
+        seconds = time.time() - start
+        return [(client_id, updates_name, slot, trainer.num_samples, seconds, trainer.last_loss) for client_id, slot, trainer in zip(client_ids, slots, trainers)]
+
+# Pool initializer: claim a core (round robin) and build the worker state (one torch thread per worker)
+def init_worker(partitions, numel, core_counter, pin_cores, model_fn=None, proximal_mu=0.0):
+    global WORKER
+
+    cores = None
+    if pin_cores and hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+        with core_counter.get_lock():
+            cores = { available[core_counter.value % len(available)] }
+            core_counter.value += 1
+
+    WORKER = SimulationWorker(partitions, numel, cores, num_threads=1, model_fn=model_fn, proximal_mu=proximal_mu)
+
+def run_clients(*args):
+    return WORKER.run_clients(*args)
+
+### Simulated Server ###
+
+# Drives the FLServer training loop over virtual clients exchanging weights through shared memory
+class SimulatedFLServer(FLServer):
+    def __init__(self, trainer, partitions, num_workers=0, pin_cores=True, model_fn=None, proximal_mu=0.0):
+        super(SimulatedFLServer, self).__init__(None, trainer)
+
+        # Clients trained together (as one batched model) per task
+        self.clients_per_task = 1
+
+        # Virtual clients with data (id -> id, standing in for address -> socket)
+        self.partitions = partitions
+        for client_id in range(len(partitions)):
+            if len(partitions[client_id]) == 0:
+                continue
+            self.connected_clients_by_addr[client_id] = client_id
+            self.connected_clients_by_sock[client_id] = client_id
+
+        numel = self.trainer.layout.numel
+
+        # Global weights (published once per round) and one update slot per selected client
+        self.weights = SharedArray((numel,))
+        self.updates = None
+
+        # Update segments by name, and the number of clients yet to write into each
+        self.segments = {}
+        self.outstanding = {}
+
+        # Finished clients: (client id, update segment, slot, number of samples, seconds, loss), with no samples if the client failed
+        self.results = queue.Queue()
+        self.client_times = {}
+
+        # Process pool (0 workers runs the clients in this process, one after another while the model is broadcast:
+        # they can't be interrupted, so the round deadline doesn't apply); model_fn builds the clients' model
+        # (None uses model1.Net) and proximal_mu is the weight of their FedProx term
+        self.num_workers = num_workers
+        self.pool = None
+        if num_workers > 0:
+            context = multiprocessing.get_context('fork' if sys.platform.startswith('linux') else 'spawn')
+            self.pool = context.Pool(num_workers, initializer=init_worker, initargs=(partitions, numel, context.Value('i', 0), pin_cores, model_fn, proximal_mu))
+        else:
+            global WORKER
+            WORKER = SimulationWorker(partitions, numel, model_fn=model_fn, proximal_mu=proximal_mu)
+
+    # Publish the model and start the selected clients
+    def broadcast_model(self):
+        if len(self.selected_clients_by_addr) == 0:
+            return False
+
+        self.weights.tensor.copy_(self.trainer.flat_state())
+
+        # a fresh update segment if stragglers may still write into the current one
+        num_slots = len(self.selected_clients_by_addr)
+        if self.updates is None or self.updates.array.shape[0] < num_slots or self.outstanding.get(self.updates.name, 0) > 0:
+            self.release_segment(self.updates)
+            self.updates = SharedArray((num_slots, self.trainer.layout.numel))
+            self.segments[self.updates.name] = self.updates
+
+        num_slots = self.updates.array.shape[0]
+        self.scheduler.record_dispatch(self.selected_clients_by_addr.keys())
+
+        # one task per group of clients_per_task clients (one slot each)
+        client_ids = list(self.selected_clients_by_addr.keys())
+        for first in range(0, len(client_ids), self.clients_per_task):
+            group = client_ids[first:first + self.clients_per_task]
+            args = (group, self.weights.name, self.updates.name, list(range(first, first + len(group))), num_slots)
+            self.outstanding[self.updates.name] = self.outstanding.get(self.updates.name, 0) + len(group)
+            if self.pool is None:
+                try:
+                    self.put_results(run_clients(*args))
+                except Exception as error:
+                    self.client_failed(group, self.updates.name, error)
+            else:
+                self.pool.apply_async(run_clients, args, callback=self.put_results, error_callback=functools.partial(self.client_failed, group, self.updates.name))
+
+        return True
+
+    # Fold in the updates of the clients that have finished (discarding cancelled ones)
+    def wait_for_updates(self, timeout=None):
+        try:
+            result = self.results.get(timeout=1.0 if timeout is None else max(0.0, min(1.0, timeout)))
+        except queue.Empty:
+            return
+
+        while result is not None:
+            client_id, updates_name, slot, num_samples, seconds, loss = result
+            if num_samples is not None:
+                self.client_times[client_id] = seconds
+                self.scheduler.record_result(client_id, time.time(), { 'train' : seconds, 'loss' : loss })
+
+            if num_samples is None and client_id in self.selected_clients_by_addr and client_id not in self.selected_clients_updates:
+                # the client failed: don't wait for it this round.
+                self.selected_clients_by_addr.pop(client_id)
+                self.selected_clients_by_sock.pop(client_id, None)
+                self.straggling_clients.pop(client_id, None)
+                self.round_target = min(self.round_target, len(self.selected_clients_by_addr))
+            elif num_samples is None:
+                self.straggling_clients.pop(client_id, None)
+            elif client_id in self.selected_clients_by_addr and client_id not in self.straggling_clients:
+                self.trainer.accumulate(self.segments[updates_name].tensor[slot], num_samples)
+                self.selected_clients_updates[client_id] = num_samples
+            else:
+                self.straggling_clients.pop(client_id, None)
+
+            self.outstanding[updates_name] -= 1
+            if updates_name != self.updates.name:
+                self.release_segment(self.segments[updates_name])
+
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                result = None
+
+    def put_results(self, results):
+        for result in results:
+            self.results.put(result)
+
+    # Virtual clients can't be interrupted: mark them busy until their (discarded) result comes back
+    def cancel_pending_clients(self):
+        for client_id in self.selected_clients_by_addr:
+            if client_id not in self.selected_clients_updates:
+                self.straggling_clients[client_id] = client_id
+
+    # Free an update segment once no client will write into it
+    def release_segment(self, segment):
+        if segment is None or self.outstanding.get(segment.name, 0) > 0:
+            return
+
+        self.segments.pop(segment.name, None)
+        self.outstanding.pop(segment.name, None)
+        segment.unlink()
+
+    # A task failed: report its clients as finished without an update (the training loop drops them from the round)
+    def client_failed(self, client_ids, updates_name, error):
+        TERM.write_failure('Simulated client(s) {} failed: {}'.format(client_ids, error))
+        for client_id in client_ids:
+            self.results.put((client_id, updates_name, None, None, None, None))
+
+    # Stop the workers and free the shared memory
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+        self.weights.unlink()
+        for segment in list(self.segments.values()):
+            segment.unlink()
+        self.segments.clear()
+
+### Main Code ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate an FL cohort on one host.')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--subset', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--partition', choices=['iid', 'digits', 'dirichlet'], default='dirichlet')
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--digits-per-client', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-pin', action='store_true')
+    parser.add_argument('--scheduler', choices=['uniform', 'round_robin', 'throughput', 'power_of_choice'], default='uniform')
+    parser.add_argument('--batch-clients', type=int, default=1, help='clients trained together as one batched model')
+    parser.add_argument('--prox', type=float, default=0.0, help='FedProx proximal term weight (0 trains plain SGD)')
+    args = parser.parse_args()
+
+    if args.partition == 'dirichlet':
+        partitions = make_partitions('dirichlet', args.clients, args.seed, alpha=args.alpha)
+    elif args.partition == 'digits':
+        partitions = make_partitions('digits', args.clients, args.seed, digits_per_client=args.digits_per_client)
+    else:
+        partitions = make_partitions('iid', args.clients, args.seed)
+
+    flServer = SimulatedFLServer(server_trainer.ServerTrainer(use_cuda=False), partitions, num_workers=args.workers, pin_cores=not args.no_pin, proximal_mu=args.prox)
+    flServer.subset_size = args.subset
+    flServer.num_rounds = args.rounds
+    flServer.scheduler = scheduler.make_scheduler(args.scheduler)
+    flServer.clients_per_task = args.batch_clients
+
+    TERM.write_info('Simulating {} clients ({} per round) on {} worker(s)...'.format(args.clients, args.subset, args.workers))
+
+    start = time.time()
+    try:
+        flServer.train()
+    finally:
+        flServer.close()
+
+    TERM.write_success('{} rounds in {:0.2f}s'.format(flServer.rounds_completed, time.time() - start))
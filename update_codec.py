@@ -0,0 +1,131 @@
+import torch
+import torch.nn.functional as F
+
+# Number of values sharing one int8 scale
+QUANT_CHUNK = 1024
+
+### Quantization Helpers ###
+
+# Quantize values to int8 with one absmax scale per chunk
+def quantize_int8(values):
+    numel = values.numel()
+    padded = F.pad(values, (0, (-numel) % QUANT_CHUNK)).view(-1, QUANT_CHUNK)
+
+    scale = padded.abs().max(1)[0].clamp_(min=1e-12) / 127.0
+    quantized = torch.round(padded / scale[:, None]).to(torch.int8)
+
+    return quantized.view(-1)[:numel], scale
+
+# Recover (approximate) values from int8 and their chunk scales
+def dequantize_int8(quantized, scale):
+    numel = quantized.numel()
+    padded = F.pad(quantized.float(), (0, (-numel) % QUANT_CHUNK)).view(-1, QUANT_CHUNK)
+
+    return (padded * scale[:, None]).view(-1)[:numel]
+
+# Compress a vector of values
+def compress(values, quantize):
+    if quantize == 'int8':
+        quantized, scale = quantize_int8(values)
+        return { 'quantize' : 'int8', 'values' : quantized, 'scale' : scale }
+    elif quantize == 'fp16':
+        return { 'quantize' : 'fp16', 'values' : values.half() }
+
+    return { 'quantize' : None, 'values' : values }
+
+# Decompress a vector of values
+def decompress(payload):
+    if payload['quantize'] == 'int8':
+        return dequantize_int8(payload['values'], payload['scale'])
+    elif payload['quantize'] == 'fp16':
+        return payload['values'].float()
+
+    return payload['values']
+
+### Codec ###
+
+# Encodes a client's weights as a (sparsified/quantized) delta against the received weights
+class DeltaCodec():
+    def __init__(self, topk=None, quantize=None, error_feedback=True):
+        # Fraction of the delta's entries to send (None sends all of them)
+        self.topk = topk
+
+        # Value encoding: None (float32), 'fp16' or 'int8'
+        self.quantize = quantize
+
+        # Carry what was not sent into the next round's delta
+        self.error_feedback = error_feedback
+        self.residual = None
+
+    # Encode flat weights relative to the flat base weights
+    def encode(self, weights, base):
+        delta = weights - base.to(weights.device)
+
+        if self.error_feedback and self.residual is not None:
+            delta += self.residual
+
+        payload = { 'codec' : 'delta', 'numel' : delta.numel(), 'indices' : None }
+
+        # Keep only the largest entries
+        if self.topk is not None:
+            k = max(1, int(self.topk * delta.numel()))
+            indices = torch.topk(delta.abs(), k, sorted=False)[1]
+            payload['indices'] = indices.int()
+            values = delta[indices]
+        else:
+            values = delta
+
+        payload.update(compress(values, self.quantize))
+
+        # Remember what the server will not see
+        if self.error_feedback and (self.topk is not None or self.quantize is not None):
+            sent = decompress(payload)
+            if self.topk is not None:
+                delta[indices] -= sent
+            else:
+                delta -= sent
+            self.residual = delta
+
+        return payload
+
+    # Forget the error-feedback residual
+    def reset(self):
+        self.residual = None
+
+# Whether a client message holds an encoded update
+def is_encoded(update):
+    return isinstance(update, dict) and 'codec' in update
+
+# Add alpha * (decoded delta) into the flat buffer out
+def decode_delta_into(payload, out, alpha=1.0):
+    values = decompress(payload).to(out.device, out.dtype)
+
+    if payload['indices'] is None:
+        out.add_(values, alpha=alpha)
+    else:
+        out.index_add_(0, payload['indices'].to(out.device).long(), values * alpha)
+
+    return out
+
+# Number of bytes of tensor data in a payload
+def payload_nbytes(payload):
+    if torch.is_tensor(payload):
+        return payload.numel() * payload.element_size()
+
+    return sum(value.numel() * value.element_size() for value in payload.values() if torch.is_tensor(value))
+
+# Build a codec from a spec such as 'delta', 'fp16', 'int8', 'topk0.01' or 'topk0.01+int8' ('full' sends weights)
+def make_codec(spec):
+    if spec is None or spec == 'full':
+        return None
+
+    topk, quantize = None, None
+    for part in spec.split('+'):
+        if part.startswith('topk'):
+            topk = float(part[len('topk'):])
+        elif part in ('fp16', 'int8'):
+            quantize = part
+        elif part != 'delta':
+            raise ValueError('Unknown codec \'{}\''.format(part))
+
+    return DeltaCodec(topk=topk, quantize=quantize)
@@ -1,4 +1,9 @@
-import time, sys, threading, errno, socket, pickle, math, struct
+import time, sys, threading, errno, socket, pickle, math, struct, io
+
+import numpy as np
+import torch
+
+from instrumentation import RECORDER
 
 class DEBUG_LEVEL:
     NONE = 0
@@ -29,43 +34,214 @@ class TERM:
     def write_warning(msg):
         sys.stdout.write(TERM.WARNING + msg + TERM.ENDC + '\n')
 
+# Pickler that moves (numpy compatible) tensors out of band.
+class TensorPickler(pickle.Pickler):
+    def __init__(self, file, tensors):
+        super(TensorPickler, self).__init__(file, protocol = pickle.HIGHEST_PROTOCOL)
+        self.tensors = tensors
+
+    def persistent_id(self, obj):
+        if isinstance(obj, torch.Tensor) and obj.layout == torch.strided and obj.dtype in Communication_Handler.WIRE_DTYPES:
+            self.tensors.append(obj.detach().cpu().contiguous())
+            return len(self.tensors) - 1
+        return None
+
+# Unpickler that resolves out of band tensors from a preallocated list.
+class TensorUnpickler(pickle.Unpickler):
+    def __init__(self, file, tensors):
+        super(TensorUnpickler, self).__init__(file)
+        self.tensors = tensors
+
+    def persistent_load(self, pid):
+        return self.tensors[pid]
+
 class Communication_Handler():
+    # Frame header: kind (1 byte) followed by a 64-bit payload length (network byte order).
+    HEADER = struct.Struct('>cQ')
+    LENGTH = struct.Struct('>Q')
+
+    PICKLE_FRAME = b'P'
+    TENSOR_FRAME = b'T'
+
+    # dtypes that are sent as raw buffers (everything else is pickled).
+    WIRE_DTYPES = {
+        torch.float64 : 'float64', torch.float32 : 'float32', torch.float16 : 'float16',
+        torch.int64 : 'int64', torch.int32 : 'int32', torch.int16 : 'int16',
+        torch.int8 : 'int8', torch.uint8 : 'uint8', torch.bool : 'bool',
+    }
+
+    # maximum number of buffers per sendmsg call.
+    IOV_MAX = 1024
+
+    # control messages (server: drop the current update; client: update dropped).
+    CANCEL_MSG = { 'control' : 'cancel' }
+
+    # connection management (client: still alive; a hello also carries the client's session and cached model version).
+    HEARTBEAT_MSG = { 'control' : 'heartbeat' }
+
+    # (a dropped update also reports the model version the client holds, None if it holds none)
+    def cancelled_msg(version=None):
+        return { 'control' : 'cancelled', 'version' : version }
+
+    def hello_msg(session, version=None):
+        return { 'control' : 'hello', 'session' : session, 'version' : version }
 
     def sendall(sock, msg):
         sock.sendall(msg)
 
+    # Sends a list of buffers without joining them (scatter/gather when available).
+    def sendall_buffers(sock, buffers):
+        buffers = [memoryview(buf).cast('B') for buf in buffers]
+        buffers = [buf for buf in buffers if len(buf) > 0]
+
+        if not hasattr(sock, 'sendmsg'):
+            for buf in buffers:
+                sock.sendall(buf)
+            return
+
+        i = 0
+        while i < len(buffers):
+            sent = sock.sendmsg(buffers[i:i + Communication_Handler.IOV_MAX])
+
+            # skip past the buffers that were fully sent.
+            while sent > 0:
+                if sent >= len(buffers[i]):
+                    sent -= len(buffers[i])
+                    i += 1
+                else:
+                    buffers[i] = buffers[i][sent:]
+                    sent = 0
+
+    # Fills the given buffer from the socket.
+    def recvall_into(sock, buf):
+        view = memoryview(buf).cast('B')
+        pos = 0
+        while pos < len(view):
+            nbytes = sock.recv_into(view[pos:])
+            if not nbytes:
+                return False
+            pos += nbytes
+        return True
+
     def recvall(sock, msg_len):
-        msg = bytearray()
-        while len(msg) < msg_len:
-            frag = sock.recv(msg_len - len(msg))
-            if not frag:
-                return None
-            msg.extend(frag)
+        msg = bytearray(msg_len)
+        if not Communication_Handler.recvall_into(sock, msg):
+            return None
         return msg
 
-    def send_msg(sock, msg):
+    # Returns a writable byte view over a (contiguous, cpu) tensor.
+    def tensor_buffer(tensor):
+        return tensor.numpy().reshape(-1).view(np.uint8)
+
+    # Allocates the tensors described by a tensor table.
+    def alloc_tensors(table):
+        return [torch.empty(shape, dtype = getattr(torch, dtype)) for dtype, shape in table]
+
+    # Serializes a message into a list of buffers forming a single frame.
+    def pack_msg(msg):
+        with RECORDER.span('serialize') as span:
+            buffers = Communication_Handler.pack_buffers(msg)
+            span.set(nbytes=Communication_Handler.frame_size(buffers))
+        return buffers
+
+    def pack_buffers(msg):
+        # serialize the message, collecting its tensors separately.
+        tensors = []
+        skeleton = io.BytesIO()
+        TensorPickler(skeleton, tensors).dump(msg)
+
+        if len(tensors) == 0:
+            smsg = skeleton.getvalue()
+            return [Communication_Handler.HEADER.pack(Communication_Handler.PICKLE_FRAME, len(smsg)), smsg]
+
+        # describe the tensors (dtype, shape) ahead of their raw contents.
+        table = [(Communication_Handler.WIRE_DTYPES[tensor.dtype], tuple(tensor.shape)) for tensor in tensors]
+        meta = pickle.dumps((table, skeleton.getvalue()), protocol = pickle.HIGHEST_PROTOCOL)
+
+        buffers = [Communication_Handler.tensor_buffer(tensor) for tensor in tensors]
+        msg_len = Communication_Handler.LENGTH.size + len(meta) + sum(buf.nbytes for buf in buffers)
+
+        return [Communication_Handler.HEADER.pack(Communication_Handler.TENSOR_FRAME, msg_len),
+                Communication_Handler.LENGTH.pack(len(meta)), meta] + buffers
+
+    # Rebuilds a message from its skeleton once its tensors have been filled.
+    def unpack_msg(skeleton, tensors):
+        return TensorUnpickler(io.BytesIO(skeleton), tensors).load()
+
+    # Total number of bytes in a packed frame.
+    def frame_size(buffers):
+        return sum(memoryview(buf).nbytes for buf in buffers)
+
+    # Sends an already packed frame (the buffers are only read, so they can be shared).
+    def send_frame(sock, buffers):
         try:
-            # serialize the message and determine its size.
-            smsg = pickle.dumps(msg)
-            smsg_len = len(smsg)
-
-            # prefix each message with a 4-byte length (network byte order).
-            smsg = struct.pack('>I', smsg_len) + smsg
-            # send the message.
-            Communication_Handler.sendall(sock, smsg)
+            with RECORDER.span('send', bytes_sent=Communication_Handler.frame_size(buffers)):
+                Communication_Handler.sendall_buffers(sock, buffers)
+            return True
         except:
             TERM.write_failure('Peer {}: Send Error \'{}\''.format('blah', sys.exc_info()[0]))
-            return
+            return False
+
+    def send_msg(sock, msg):
+        # send the message.
+        return Communication_Handler.send_frame(sock, Communication_Handler.pack_msg(msg))
 
     def recv_msg(sock):
         try:
-            msg_len = Communication_Handler.recvall(sock, 4)
-            if msg_len:
-                msg_len = struct.unpack('>I', msg_len)[0]
-                # receive the message.
-                smsg = Communication_Handler.recvall(sock, msg_len)
-                msg = pickle.loads(smsg)
-                return msg
+            header = Communication_Handler.recvall(sock, Communication_Handler.HEADER.size)
+            if header:
+                kind, msg_len = Communication_Handler.HEADER.unpack(header)
+                with RECORDER.span('recv', bytes_received=Communication_Handler.HEADER.size + msg_len):
+                    return Communication_Handler.recv_payload(sock, kind, msg_len)
         except:
             TERM.write_failure('Peer {}: Receive error {}'.format('blah', sys.exc_info()[0]))
             return None
+
+    # Receives the rest of a frame (after its header).
+    def recv_payload(sock, kind, msg_len):
+        # receive the message.
+        if kind == Communication_Handler.PICKLE_FRAME:
+            return pickle.loads(Communication_Handler.recvall(sock, msg_len))
+
+        meta_len = Communication_Handler.LENGTH.unpack(Communication_Handler.recvall(sock, Communication_Handler.LENGTH.size))[0]
+        table, skeleton = pickle.loads(Communication_Handler.recvall(sock, meta_len))
+
+        # receive the raw tensor contents directly into their final storage.
+        tensors = Communication_Handler.alloc_tensors(table)
+        for tensor in tensors:
+            if not Communication_Handler.recvall_into(sock, Communication_Handler.tensor_buffer(tensor)):
+                return None
+
+        return Communication_Handler.unpack_msg(skeleton, tensors)
+
+    # Returns the control command of a message (None for other messages).
+    def control_msg(msg):
+        if isinstance(msg, dict):
+            return msg.get('control')
+        return None
+
+    # Splits a client's message into its update and its weight (sample count).
+    def unpack_update(msg):
+        if isinstance(msg, dict) and 'update' in msg:
+            return msg['update'], msg.get('num_samples', 1)
+        return msg, 1
+
+    # Reads a single frame from an asyncio stream (raises on EOF).
+    async def read_msg(reader):
+        header = await reader.readexactly(Communication_Handler.HEADER.size)
+        kind, msg_len = Communication_Handler.HEADER.unpack(header)
+
+        # receive the message.
+        if kind == Communication_Handler.PICKLE_FRAME:
+            return pickle.loads(await reader.readexactly(msg_len))
+
+        meta_len = Communication_Handler.LENGTH.unpack(await reader.readexactly(Communication_Handler.LENGTH.size))[0]
+        table, skeleton = pickle.loads(await reader.readexactly(meta_len))
+
+        tensors = Communication_Handler.alloc_tensors(table)
+        for tensor in tensors:
+            buf = Communication_Handler.tensor_buffer(tensor)
+            if buf.nbytes > 0:
+                buf[:] = np.frombuffer(await reader.readexactly(buf.nbytes), dtype = np.uint8)
+
+        return Communication_Handler.unpack_msg(skeleton, tensors)